@@ -3,19 +3,17 @@
 # Definire il percorso del server BBS e dello script
 BBS_SERVER="/opt/mybbs/bbs_server.py"
 BACKUP_DIR="/opt/mybbs/backups"
-TIMESTAMP=$(date +"%Y%m%d_%H%M%S")
-BACKUP_FILE="database_backup_$TIMESTAMP.db"
+BACKUP_FILE="database_backup.db"
+KEEP=30
 
-# Eseguire il backup utilizzando lo script del server BBS
-sudo -u bbsuser python3 $BBS_SERVER --backup "$BACKUP_DIR/$BACKUP_FILE"
+# Backup online compresso: se il server è avviato lo esegue lui (socket admin),
+# a passi, senza fermare le scritture; le copie precedenti vengono ruotate
+# in database_backup.db.gz.1 ... database_backup.db.gz.$KEEP
+sudo -u bbsuser python3 $BBS_SERVER --backup "$BACKUP_DIR/$BACKUP_FILE" --backup-compress --backup-keep $KEEP
 
 # Verificare se il backup è stato creato con successo
 if [ $? -eq 0 ]; then
-    echo "Backup effettuato con successo: $BACKUP_FILE"
+    echo "Backup effettuato con successo: $BACKUP_FILE.gz"
 else
     echo "Errore durante il backup del database."
 fi
-
-# Opzionale: Eliminare backup più vecchi di 30 giorni
-find $BACKUP_DIR -type f -name "database_backup_*.db" -mtime +30 -exec rm {} \;
-
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+import os
+import sys
+import math
+import time
+import json
+import shlex
+import random
+import shutil
+import socket
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import bcrypt
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(BASE_DIR, 'bbs_server.py')
+SCHEMA_FILE = os.path.join(BASE_DIR, 'schema.sql')
+
+RESULT_FORMAT = 1               # da incrementare se cambia la struttura del JSON
+BENCH_PASSWORD = 'bench'
+SERVER_START_TIMEOUT = 60       # secondi per l'avvio (migrazioni e indici sul db appena creato)
+
+# Operazioni del carico: nome per --mix -> chiave nei risultati (come in ADMIN STATS)
+OPERATIONS = {
+    'login': 'LOGIN',
+    'board_list': 'BOARD LIST',
+    'board_read': 'BOARD READ',
+    'board_new': 'BOARD NEW',
+    'chat_send': 'CHAT SEND',
+    'chat_recv': 'CHAT RECV',
+    'file_list': 'FILE LIST',
+    'text_read': 'TEXT READ',
+}
+DEFAULT_MIX = ('board_list=25,board_read=25,board_new=5,chat_send=10,'
+               'chat_recv=15,file_list=10,text_read=9,login=1')
+
+WORDS = ('bacheca', 'messaggio', 'risposta', 'server', 'archivio', 'documento', 'utente',
+         'rete', 'modem', 'chiamata', 'linea', 'notte', 'file', 'sistema', 'testo', 'porta')
+
+def parse_mix(spec):
+    """'board_list=30,chat_send=10' -> {'board_list': 30, 'chat_send': 10}."""
+    mix = {}
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        name, _, weight = item.partition('=')
+        name = name.strip().lower().replace('-', '_')
+        if name not in OPERATIONS:
+            raise ValueError(f"operazione sconosciuta '{name}' (valide: {', '.join(OPERATIONS)})")
+        try:
+            mix[name] = int(weight) if weight else 1
+        except ValueError:
+            raise ValueError(f"peso non valido per {name}: '{weight}'")
+        if mix[name] < 0:
+            raise ValueError(f"peso negativo per {name}")
+    if not any(mix.values()):
+        raise ValueError("il mix non contiene operazioni")
+    return mix
+
+def parse_levels(spec):
+    """'10,50,100' -> [10, 50, 100]."""
+    levels = [int(x) for x in spec.split(',') if x.strip()]
+    if not levels or min(levels) < 1:
+        raise ValueError("numero di client non valido")
+    return levels
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+def seed_data(root, args, rng):
+    """
+    Crea database, documenti e file di prova in root. I file sono registrati come
+    quelli delle versioni precedenti (solo nome): il server li migra nell'archivio
+    per hash al primo avvio. Restituisce gli id dei thread e i nomi dei documenti.
+    """
+    db_path = os.path.join(root, 'database.db')
+    docs_dir = os.path.join(root, 'docs')
+    upload_dir = os.path.join(root, 'uploads')
+    os.makedirs(docs_dir)
+    os.makedirs(upload_dir)
+
+    conn = sqlite3.connect(db_path)
+    with open(SCHEMA_FILE, encoding='utf-8') as f:
+        conn.executescript(f.read())
+    # Un solo hash per tutti: LOGIN costa comunque un bcrypt.checkpw completo
+    phash = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    conn.executemany("INSERT INTO users(username, password_hash, role) VALUES (?, ?, 'user')",
+                     [(f"bench{i}", phash) for i in range(args.users)])
+    ts = time.strftime("%Y-%m-%d %H:%M:%S")
+    thread_ids = []
+    for _ in range(args.threads):
+        author = rng.randint(1, args.users)
+        cur = conn.execute("""
+            INSERT INTO board_messages(author_id, timestamp, subject, body, parent_id)
+            VALUES (?, ?, ?, ?, NULL)
+        """, (author, ts, sentence(rng, 4), sentence(rng, 60)))
+        thread_ids.append(cur.lastrowid)
+        messages = [cur.lastrowid]
+        for _ in range(args.replies):
+            cur = conn.execute("""
+                INSERT INTO board_messages(author_id, timestamp, subject, body, parent_id)
+                VALUES (?, ?, ?, ?, ?)
+            """, (rng.randint(1, args.users), ts, sentence(rng, 3), sentence(rng, 30), rng.choice(messages)))
+            messages.append(cur.lastrowid)
+    for i in range(args.files):
+        name = f"bench{i}.bin"
+        with open(os.path.join(upload_dir, name), 'wb') as f:
+            f.write(rng.randbytes(args.file_size))
+        conn.execute("""
+            INSERT INTO files(uploader_id, filename, description, visibility)
+            VALUES (?, ?, ?, 'public')
+        """, (rng.randint(1, args.users), name, sentence(rng, 5)))
+    conn.commit()
+    conn.close()
+
+    doc_names = []
+    for i in range(args.docs):
+        name = f"bench{i}.txt"
+        lines = []
+        size = 0
+        while size < args.doc_size:
+            line = sentence(rng, 12)
+            lines.append(line)
+            size += len(line) + 1
+        with open(os.path.join(docs_dir, name), 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        doc_names.append(name)
+    return db_path, docs_dir, upload_dir, thread_ids, doc_names
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(root, db_path, docs_dir, upload_dir, port, server_args, rate_limit=False):
+    # Di norma si misura la capacità del server, non la politica dei limiti di frequenza
+    if not rate_limit:
+        server_args = ['--no-rate-limit'] + server_args
+    cmd = [sys.executable, SERVER_SCRIPT,
+           '--host', '127.0.0.1', '--port', str(port),
+           '--db', db_path, '--docs-dir', docs_dir, '--upload-dir', upload_dir,
+           '--admin-sock', os.path.join(root, 'bbs_server.sock'),
+           '--log-file', os.path.join(root, 'bbs_server.log'),
+           '--log-level', 'WARNING'] + server_args
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"il server è terminato all'avvio (codice {proc.returncode})")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"il server non risponde sulla porta {port} dopo {SERVER_START_TIMEOUT}s")
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+class BenchClient:
+    """Un utente simulato: una connessione, un comando alla volta (v1 o v2)."""
+    def __init__(self, n, port, proto, rng, thread_ids, doc_names):
+        self.username = f"bench{n}"
+        self.port = port
+        self.proto = proto
+        self.rng = rng
+        self.thread_ids = thread_ids
+        self.doc_names = doc_names
+        self.reader = None
+        self.writer = None
+        self.reqid = 0
+        self.chat_seq = 0
+        self.posts = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port, limit=1024 * 1024)
+        if not (await self.reader.readline()).startswith(b"OK"):
+            raise ConnectionError("server non pronto")
+        if self.proto == 2:
+            self.writer.write(b"PROTO 2\n")
+            if (await self.reader.readline()).strip() != b"OK PROTO 2":
+                raise ConnectionError("protocollo v2 non supportato")
+        if not (await self.command(f"LOGIN {self.username} {BENCH_PASSWORD}")).startswith("OK"):
+            raise ConnectionError(f"login di {self.username} fallito")
+
+    async def command(self, line):
+        payload = line.encode('utf-8')
+        if self.proto == 1:
+            self.writer.write(payload + b"\n")
+            while True:
+                raw = await self.reader.readline()
+                if not raw:
+                    raise ConnectionError("connessione chiusa dal server")
+                if raw.startswith(b"OK") or raw.startswith(b"ERR"):
+                    return raw.decode('utf-8', errors='replace').rstrip('\n')
+        self.reqid += 1
+        self.writer.write(f"{self.reqid} {len(payload)}\n".encode('ascii') + payload)
+        rid, length = (int(x) for x in (await self.reader.readline()).split())
+        data = await self.reader.readexactly(length)
+        if rid != self.reqid:
+            raise ConnectionError(f"risposta con reqid {rid} invece di {self.reqid}")
+        # Interessa solo l'esito: l'ultima riga della risposta
+        return data.decode('utf-8', errors='replace').rstrip('\n').rsplit('\n', 1)[-1]
+
+    def request(self, op):
+        """Riga di comando per l'operazione op."""
+        if op == 'login':
+            return f"LOGIN {self.username} {BENCH_PASSWORD}"
+        if op == 'board_list':
+            return "BOARD LIST"
+        if op == 'board_read':
+            return f"BOARD READ {self.rng.choice(self.thread_ids)}"
+        if op == 'board_new':
+            self.posts += 1
+            return f"BOARD NEW bench {self.username} {self.posts}|{sentence(self.rng, 40)}"
+        if op == 'chat_send':
+            return f"CHAT SEND {sentence(self.rng, 8)}"
+        if op == 'chat_recv':
+            return f"CHAT RECV SINCE {self.chat_seq}"
+        if op == 'file_list':
+            return "FILE LIST"
+        return f"TEXT READ {self.rng.choice(self.doc_names)}"
+
+    async def run(self, ops, weights, start, stop, think, samples, errors, busy):
+        """Esegue operazioni fino a stop; registra solo quelle concluse tra start e stop."""
+        while time.perf_counter() < stop:
+            op = self.rng.choices(ops, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                reply = await self.command(self.request(op))
+                failed = not reply.startswith("OK")
+            except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+                errors[op] += 1
+                return
+            t1 = time.perf_counter()
+            if op == 'chat_recv' and not failed:
+                seq = reply[2:].strip()
+                if seq.isdigit():
+                    self.chat_seq = int(seq)
+            if start <= t1 <= stop:
+                samples[op].append(t1 - t0)
+                if reply.startswith("ERR BUSY"):
+                    busy[op] += 1
+                else:
+                    errors[op] += failed
+            if think:
+                await asyncio.sleep(self.rng.expovariate(1.0 / think))
+
+    async def close(self):
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+def percentile(values, q):
+    """Percentile a rango più vicino su una lista già ordinata."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+def summarize(values, errors, busy, window):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'busy': busy,
+        'ops_per_s': round(len(values) / window, 1),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+async def run_level(n_clients, args, mix, port, thread_ids, doc_names):
+    """Un livello di carico: n_clients utenti per warmup + duration secondi."""
+    rng = random.Random(args.seed + n_clients)
+    clients = [BenchClient(i % args.users, port, args.proto, random.Random(rng.random()), thread_ids, doc_names)
+               for i in range(n_clients)]
+    results = await asyncio.gather(*(c.connect() for c in clients), return_exceptions=True)
+    connected = [c for c, r in zip(clients, results) if not isinstance(r, Exception)]
+    connect_errors = n_clients - len(connected)
+
+    ops = [op for op, w in mix.items() if w > 0]
+    weights = [mix[op] for op in ops]
+    samples = {op: [] for op in ops}
+    errors = {op: 0 for op in ops}
+    busy = {op: 0 for op in ops}
+    start = time.perf_counter() + args.warmup
+    stop = start + args.duration
+    await asyncio.gather(*(c.run(ops, weights, start, stop, args.think / 1000.0, samples, errors, busy)
+                           for c in connected))
+    await asyncio.gather(*(c.close() for c in connected))
+
+    everything = [v for values in samples.values() for v in values]
+    return {
+        'clients': n_clients,
+        'connect_errors': connect_errors,
+        'total': summarize(everything, sum(errors.values()), sum(busy.values()), args.duration),
+        'commands': {OPERATIONS[op]: summarize(samples[op], errors[op], busy[op], args.duration) for op in ops},
+    }
+
+def format_text(report):
+    out = []
+    for run in report['runs']:
+        t = run['total']
+        out.append(f"=== {run['clients']} client: {t['ops_per_s']} op/s, p50 {t['p50_ms']} ms, "
+                   f"p99 {t['p99_ms']} ms, errori {t['errors']}, rifiutati {t['busy']}, "
+                   f"connessioni fallite {run['connect_errors']}")
+        out.append(f"{'COMANDO':<14}{'N':>9}{'ERR':>7}{'BUSY':>7}{'OP/S':>10}{'P50ms':>10}{'P95ms':>10}"
+                   f"{'P99ms':>10}{'MAXms':>10}")
+        for key, s in run['commands'].items():
+            out.append(f"{key:<14}{s['count']:>9}{s['errors']:>7}{s['busy']:>7}{s['ops_per_s']:>10.1f}{s['p50_ms']:>10.2f}"
+                       f"{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}{s['max_ms']:>10.2f}")
+    return "\n".join(out) + "\n"
+
+def raise_fd_limit():
+    # Ogni client è un socket, in questo processo e nel server che eredita il limite
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark del server BBS: avvia bbs_server.py su un database temporaneo "
+                    "e simula N client del protocollo",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--clients', default='50',
+                        help='Client simultanei; più valori separati da virgola per provare livelli crescenti')
+    parser.add_argument('--duration', type=float, default=30.0, help='Secondi misurati per ogni livello')
+    parser.add_argument('--warmup', type=float, default=3.0, help='Secondi iniziali non misurati')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Pesi delle operazioni (operazione=peso,...)')
+    parser.add_argument('--think', type=float, default=0.0,
+                        help='Pausa media (ms) di ogni client tra due comandi; 0 = a ciclo continuo')
+    parser.add_argument('--proto', type=int, choices=(1, 2), default=2, help='Versione del protocollo')
+    parser.add_argument('--seed', type=int, default=1, help='Seme casuale per dati e carico')
+    parser.add_argument('--users', type=int, default=200, help='Utenti nel database di prova')
+    parser.add_argument('--threads', type=int, default=500, help='Thread della bacheca')
+    parser.add_argument('--replies', type=int, default=10, help='Risposte per thread')
+    parser.add_argument('--docs', type=int, default=20, help='Documenti testuali')
+    parser.add_argument('--doc-size', type=int, default=32 * 1024, help='Dimensione dei documenti (byte)')
+    parser.add_argument('--files', type=int, default=100, help="File nell'archivio")
+    parser.add_argument('--file-size', type=int, default=4096, help='Dimensione dei file (byte)')
+    parser.add_argument('--server-args', default='', help='Opzioni aggiuntive per bbs_server.py (es. "--workers 64")')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='Lascia attivi i limiti di frequenza del server (i rifiuti ERR BUSY sono contati a parte)')
+    parser.add_argument('--format', choices=('json', 'text'), default='json', help='Formato dei risultati')
+    parser.add_argument('--output', help='File dei risultati (default: standard output)')
+    parser.add_argument('--keep', action='store_true', help='Non cancella la cartella temporanea (log del server)')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+        levels = parse_levels(args.clients)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.users < 1 or args.threads < 1 or args.docs < 1:
+        parser.error("servono almeno un utente, un thread e un documento")
+
+    raise_fd_limit()
+    root = tempfile.mkdtemp(prefix='bbs_bench_')
+    rng = random.Random(args.seed)
+    proc = None
+    try:
+        print(f"Preparazione dei dati in {root}...", file=sys.stderr)
+        db_path, docs_dir, upload_dir, thread_ids, doc_names = seed_data(root, args, rng)
+        port = free_port()
+        proc = start_server(root, db_path, docs_dir, upload_dir, port, shlex.split(args.server_args),
+                            args.rate_limit)
+        runs = []
+        for n in levels:
+            print(f"{n} client per {args.warmup:g}+{args.duration:g}s...", file=sys.stderr)
+            runs.append(asyncio.run(run_level(n, args, mix, port, thread_ids, doc_names)))
+            if proc.poll() is not None:
+                raise RuntimeError(f"il server è terminato durante la prova (codice {proc.returncode})")
+    except RuntimeError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+        if args.keep:
+            print(f"Dati e log del server in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    # Solo parametri e misure, niente date o percorsi: due esecuzioni si confrontano con diff
+    report = {
+        'format': RESULT_FORMAT,
+        'config': {
+            'clients': levels,
+            'duration_s': args.duration,
+            'warmup_s': args.warmup,
+            'mix': {OPERATIONS[op]: w for op, w in mix.items()},
+            'think_ms': args.think,
+            'proto': args.proto,
+            'seed': args.seed,
+            'data': {'users': args.users, 'threads': args.threads, 'replies': args.replies,
+                     'docs': args.docs, 'doc_size': args.doc_size,
+                     'files': args.files, 'file_size': args.file_size},
+            'server_args': args.server_args,
+            'rate_limit': args.rate_limit,
+        },
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n" if args.format == 'json' else format_text(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -5,41 +5,354 @@ import os
 import getpass
 import argparse
 import time
+import queue
+import threading
+import hashlib
+import itertools
+import zlib
+from collections import deque, OrderedDict
 
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 12345
+COMPRESS_MIN = 200      # comandi più corti si inviano senza comprimerli
+CACHE_ENTRIES = 32      # risposte conservate per le richieste IFNEWER
+BUSY_MAX_WAIT = 5       # con ERR BUSY si riprova da soli se l'attesa richiesta non supera questi secondi
+BUSY_ATTEMPTS = 5       # tentativi prima di arrendersi a un server occupato
 
-def send_cmd(sock, cmd):
-    try:
-        sock.sendall((cmd + "\n").encode('utf-8'))
-    except Exception as e:
-        print(f"Errore inviando il comando: {e}")
-        sys.exit(1)
+# Comandi che si possono ripetere senza effetti collaterali dopo una riconnessione
+SAFE_TO_RETRY = ('ROLE', 'WHO', 'WHOAMI', 'BOARD LIST', 'BOARD READ', 'BOARD SEARCH', 'CHAT RECV',
+                 'FILE LIST', 'FILE INFO', 'TEXT LIST', 'TEXT READ', 'TEXT SEARCH',
+                 'PMSG LIST', 'PMSG UNREAD')
 
-    response = []
-    while True:
-        try:
-            data = sock.recv(4096)
-            if not data:
+class BBSConnection:
+    """
+    Connessione al server che, se cade, si ricollega da sola e riprende la
+    sessione con il token ricevuto al login (RESUME), senza richiedere la password.
+
+    Con i server che lo supportano si passa al protocollo v2 (PROTO 2): ogni
+    richiesta e risposta è un frame "<reqid> <lunghezza>\n<dati>", quindi le
+    risposte si leggono per lunghezza e più comandi possono essere in volo
+    insieme (pipeline). I messaggi push del server arrivano con reqid 0.
+
+    Con compress=True (linee lente) si chiede COMPRESS zlib: da lì in poi i
+    dati viaggiano in blocchi "Z <n>" (compressi) o "R <n>" (così come sono).
+    """
+    def __init__(self, host, port, proto=2, compress=False):
+        self.host = host
+        self.port = port
+        self.want_proto = proto
+        self.want_compress = compress
+        self.proto = 1
+        self.sock = None
+        self.token = None
+        self.login_error = None
+        self.buf = bytearray()
+        self.scanned = 0            # byte di buf già esaminati in cerca di "\n"
+        self.ids = itertools.count(1)
+        self.pending = {}           # risposte v2 arrivate fuori ordine
+        self.pushes = deque()       # messaggi push letti mentre si attendeva una risposta
+        self.deflate = None
+        self.inflate = None
+        self.rawbuf = bytearray()   # byte ricevuti non ancora decompressi
+        self.raw_left = 0           # byte ancora da leggere del blocco R corrente
+        self.cache = OrderedDict()  # comando -> (revisione, righe della risposta), sopravvive alle riconnessioni
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.buf.clear()
+        self.scanned = 0
+        self.pending.clear()
+        self.proto = 1
+        self.deflate = None
+        self.inflate = None
+        self.rawbuf.clear()
+        self.raw_left = 0
+        if not self.readline().startswith("OK"):
+            raise ConnectionError("Server non pronto")
+        if self.want_proto >= 2:
+            self.sock.sendall(b"PROTO 2\n")
+            # I server senza v2 rispondono con un errore e si resta in v1
+            if self.readline().strip() == "OK PROTO 2":
+                self.proto = 2
+        if self.want_compress:
+            # Anche qui un server che non conosce il comando risponde ERR e si prosegue senza
+            if self.command("COMPRESS zlib").strip() == "OK COMPRESS zlib":
+                self.deflate = zlib.compressobj(6)
+                self.inflate = zlib.decompressobj()
+
+    def recv_sock(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("Connessione chiusa dal server")
+        return data
+
+    def fill(self):
+        if self.inflate is None:
+            self.buf += self.recv_sock()
+            return
+        # Un blocco alla volta; i blocchi R lunghi (download) passano a pezzi
+        while True:
+            if self.raw_left:
+                if not self.rawbuf:
+                    self.rawbuf += self.recv_sock()
+                n = min(self.raw_left, len(self.rawbuf))
+                self.buf += self.rawbuf[:n]
+                del self.rawbuf[:n]
+                self.raw_left -= n
+                return
+            pos = self.rawbuf.find(b"\n")
+            if pos < 0:
+                self.rawbuf += self.recv_sock()
+                continue
+            kind, length = self.rawbuf[:pos].split()
+            length = int(length)
+            if kind == b"R":
+                del self.rawbuf[:pos + 1]
+                self.raw_left = length
+                continue
+            if len(self.rawbuf) < pos + 1 + length:
+                self.rawbuf += self.recv_sock()
+                continue
+            self.buf += self.inflate.decompress(bytes(self.rawbuf[pos + 1:pos + 1 + length]))
+            del self.rawbuf[:pos + 1 + length]
+            return
+
+    def send(self, data):
+        if self.deflate is not None:
+            if len(data) < COMPRESS_MIN:
+                data = b"R %d\n" % len(data) + data
+            else:
+                body = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+                data = b"Z %d\n" % len(body) + body
+        self.sock.sendall(data)
+
+    def readline(self):
+        # Si cerca "\n" solo nei byte nuovi: costo lineare anche per risposte lunghe
+        while True:
+            pos = self.buf.find(b"\n", self.scanned)
+            if pos >= 0:
                 break
-            rx = data.decode('utf-8')
-            response.extend(rx.split('\n'))
-            if any(r.startswith('OK') or r.startswith('ERR') for r in response):
+            self.scanned = len(self.buf)
+            self.fill()
+        line = bytes(self.buf[:pos])
+        del self.buf[:pos + 1]
+        self.scanned = 0
+        return line.decode('utf-8').rstrip('\r')
+
+    def read_exact(self, n):
+        while len(self.buf) < n:
+            self.fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        self.scanned = 0
+        return data
+
+    def begin(self, cmd):
+        """Invia un comando senza attendere la risposta; restituisce il reqid (None in v1)."""
+        payload = cmd.encode('utf-8')
+        if self.proto == 1:
+            self.send(payload + b"\n")
+            return None
+        reqid = next(self.ids)
+        self.send(f"{reqid} {len(payload)}\n".encode('ascii') + payload)
+        return reqid
+
+    def reply_length(self, reqid):
+        """v2: legge intestazioni di frame fino a quella di reqid e ne restituisce la lunghezza."""
+        while True:
+            rid, length = (int(x) for x in self.readline().split())
+            if rid == reqid:
+                return length
+            payload = self.read_exact(length).decode('utf-8')
+            if rid == 0:
+                self.pushes.append(payload)
+            else:
+                self.pending[rid] = payload
+
+    def reply(self, reqid):
+        """Risposta completa a un comando inviato con begin()."""
+        if self.proto == 1:
+            lines = []
+            while True:
+                line = self.readline()
+                lines.append(line)
+                if line.startswith("OK") or line.startswith("ERR"):
+                    return "\n".join(lines) + "\n"
+        if reqid in self.pending:
+            return self.pending.pop(reqid)
+        return self.read_exact(self.reply_length(reqid)).decode('utf-8')
+
+    def command(self, cmd):
+        return self.reply(self.begin(cmd))
+
+    def pipeline(self, cmds):
+        """Invia tutti i comandi in un colpo solo e poi ne raccoglie le risposte, nell'ordine."""
+        ids = [self.begin(c) for c in cmds]
+        return [self.reply(i) for i in ids]
+
+    def read_message(self):
+        """
+        Prossimo messaggio dal server, per chi legge in continuo (chat in tempo reale):
+        ('push', testo) per i messaggi non richiesti, ('reply', testo) per le risposte.
+        """
+        if self.proto == 1:
+            line = self.readline()
+            return ('push' if line.startswith("MSG ") else 'reply'), line
+        rid, length = (int(x) for x in self.readline().split())
+        payload = self.read_exact(length).decode('utf-8').rstrip('\n')
+        return ('push' if rid == 0 else 'reply'), payload
+
+    def command_busy(self, cmd, attempts=BUSY_ATTEMPTS):
+        """Come command(), ma con ERR BUSY attende e ripete: il server non ha eseguito il comando."""
+        for _ in range(attempts - 1):
+            resp = self.command(cmd)
+            wait = busy_wait(resp.split('\n'))
+            if wait is None or wait > BUSY_MAX_WAIT:
+                return resp
+            print(f"Server occupato, nuovo tentativo tra {wait}s...")
+            time.sleep(wait)
+        return self.command(cmd)
+
+    def login(self, user, pw):
+        resp = self.command_busy(f"LOGIN {user} {pw}").strip()
+        self.login_error = resp
+        if not resp.startswith("OK"):
+            return False
+        parts = resp.split(' ')
+        self.token = parts[3] if len(parts) > 3 else None
+        return True
+
+    def reconnect(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        for attempt in range(5):
+            try:
+                self.connect()
                 break
-        except Exception as e:
-            print(f"Errore ricevendo la risposta: {e}")
+            except Exception:
+                time.sleep(min(2 ** attempt, 10))
+        else:
+            return False
+        if self.token:
+            resp = self.command_busy(f"RESUME {self.token}")
+            if resp.startswith("OK"):
+                return True
+            if resp.startswith("ERR BUSY"):
+                # Il token è ancora buono: chiedere la password costerebbe un bcrypt in più al server
+                return False
+        # Token scaduto o assente: serve di nuovo la password
+        print("Sessione scaduta, effettua di nuovo il login.")
+        user = input("Username BBS: ")
+        pw = getpass.getpass("Password BBS: ")
+        return self.login(user, pw)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv(self, n):
+        # Prima i byte già letti nel buffer, poi il socket
+        if not self.buf and self.inflate is not None:
+            self.fill()
+        if self.buf:
+            data = bytes(self.buf[:n])
+            del self.buf[:n]
+            self.scanned = 0
+            return data
+        return self.sock.recv(n)
+
+    def sendfile(self, f, offset, count):
+        # Con COMPRESS il contenuto del file va in un unico blocco non compresso
+        if self.deflate is not None:
+            self.sock.sendall(b"R %d\n" % count)
+        return self.sock.sendfile(f, offset, count)
+
+def busy_wait(response):
+    """Secondi indicati da ERR BUSY retry-after=N, None se la risposta non è un rifiuto per carico."""
+    last = [l for l in response if l.strip()][-1:]
+    if not last or not last[0].startswith("ERR BUSY"):
+        return None
+    _, _, wait = last[0].partition("retry-after=")
+    return int(wait) if wait.strip().isdigit() else 1
+
+def send_cmd(sock, cmd, retry=True):
+    try:
+        response = sock.command_busy(cmd).split('\n')
+    except Exception as e:
+        if not retry:
+            print(f"Errore di comunicazione con il server: {e}")
             sys.exit(1)
+        print("Connessione persa, riconnessione in corso...")
+        if not sock.reconnect():
+            print("Impossibile riconnettersi al server.")
+            sys.exit(1)
+        if cmd.upper().startswith(SAFE_TO_RETRY):
+            return send_cmd(sock, cmd, retry=False)
+        # Non si sa se il server ha eseguito il comando: meglio non ripeterlo da soli
+        return ["ERR Connessione ripristinata, ripetere l'operazione"]
     return response
 
-def get_role(sock):
+def send_cmds(sock, cmds, retry=True):
+    """Più comandi in un solo giro (pipeline); restituisce le risposte nell'ordine dei comandi."""
+    try:
+        return [r.split('\n') for r in sock.pipeline(cmds)]
+    except Exception as e:
+        if not retry:
+            print(f"Errore di comunicazione con il server: {e}")
+            sys.exit(1)
+        print("Connessione persa, riconnessione in corso...")
+        if not sock.reconnect():
+            print("Impossibile riconnettersi al server.")
+            sys.exit(1)
+        if all(c.upper().startswith(SAFE_TO_RETRY) for c in cmds):
+            return send_cmds(sock, cmds, retry=False)
+        return [["ERR Connessione ripristinata, ripetere l'operazione"]]
+
+def split_rev(resp):
+    """Toglie " REV <n>" dalla riga di stato finale; restituisce (righe, revisione o None)."""
+    for i in range(len(resp) - 1, -1, -1):
+        if not resp[i].strip():
+            continue
+        head, sep, rev = resp[i].rpartition(" REV ")
+        if sep and head.startswith("OK") and rev.isdigit():
+            return resp[:i] + [head] + resp[i + 1:], int(rev)
+        break
+    return resp, None
+
+def cached_cmds(sock, cmds):
     """
-    Richiede al server il ruolo dell'utente corrente (admin o user).
+    Come send_cmds, con la cache locale delle risposte: per un comando già in
+    cache si chiede "<CMD> <SUB> IFNEWER <rev> ..." e, se il server risponde
+    OK NOTMODIFIED, si riusa la copia locale. Si conservano solo le risposte
+    che riportano una revisione (BOARD LIST/READ, FILE LIST, TEXT LIST/READ).
     """
-    resp = send_cmd(sock, "ROLE")
-    for r in resp:
-        if r.startswith("OK "):
-            return r.split(' ', 1)[1]  # "admin" o "user"
-    return "user"  # fallback
+    wire = []
+    for cmd in cmds:
+        entry = sock.cache.get(cmd)
+        if entry:
+            words = cmd.split(' ', 2)
+            wire.append(' '.join(words[:2] + [f"IFNEWER {entry[0]}"] + words[2:]))
+        else:
+            wire.append(cmd)
+    out = []
+    for cmd, resp in zip(cmds, send_cmds(sock, wire)):
+        if resp and resp[0] == "OK NOTMODIFIED" and cmd in sock.cache:
+            sock.cache.move_to_end(cmd)
+            out.append(sock.cache[cmd][1])
+            continue
+        resp, rev = split_rev(resp)
+        if rev is not None:
+            sock.cache[cmd] = (rev, resp)
+            sock.cache.move_to_end(cmd)
+            while len(sock.cache) > CACHE_ENTRIES:
+                sock.cache.popitem(last=False)
+        out.append(resp)
+    return out
+
+def cached_cmd(sock, cmd):
+    return cached_cmds(sock, [cmd])[0]
 
 def admin_menu(sock):
     """
@@ -54,6 +367,7 @@ def admin_menu(sock):
         print("[5] Revoca admin da utente")
         print("[6] Lista utenti registrati")
         print("[7] Backup database")
+        print("[8] Statistiche del server")
         print("[back] Torna indietro")
 
         choice = input("> ").strip().lower()
@@ -110,6 +424,11 @@ def admin_menu(sock):
             for r in out:
                 if r.strip():
                     print(r)
+        elif choice == '8':
+            out = send_cmd(sock, "ADMIN STATS")
+            for r in out:
+                if r.strip():
+                    print(r)
         elif choice == 'back':
             return
         else:
@@ -152,13 +471,27 @@ def main_menu(sock, role):
         else:
             print("Opzione non valida.")
 
+def next_cursor(resp):
+    """
+    Restituisce il cursore della pagina successiva se la risposta termina con 'OK MORE <cursore>'.
+    """
+    for r in resp:
+        if r.startswith("OK MORE "):
+            return r.split()[2]
+    return None
+
 def board_menu(sock):
-    # Invariato rispetto alle versioni precedenti
+    # Pagina successiva dell'ultima lista/lettura/ricerca: prefisso del comando + cursore
+    more_prefix = None
+    next_page = None
     while True:
         print("\nBacheca Messaggi:")
         print("[n] Nuovo messaggio")
         print("[l] Lista")
-        print("[r <id>] Leggi")
+        if next_page:
+            print("[m] Pagina successiva")
+        print("[s <testo>] Cerca")
+        print("[r <id> [<id> ...]] Leggi uno o più messaggi")
         print("[reply <id>] Rispondi")
         print("[back] Indietro")
 
@@ -177,10 +510,23 @@ def board_menu(sock):
             body = "\n".join(lines)
             out = send_cmd(sock, f"BOARD NEW {subject}|{body}")
         elif line == 'l':
-            out = send_cmd(sock, "BOARD LIST")
+            more_prefix = "BOARD LIST "
+            out = cached_cmd(sock, "BOARD LIST")
+        elif line == 'm' and next_page:
+            out = cached_cmd(sock, next_page)
+        elif line.startswith('s '):
+            text = line.split(' ', 1)[1].replace('|', ' ').strip()
+            more_prefix = f"BOARD SEARCH {text}||"
+            out = send_cmd(sock, f"BOARD SEARCH {text}")
         elif line.startswith('r '):
-            msg_id = line.split(' ', 1)[1]
-            out = send_cmd(sock, f"BOARD READ {msg_id}")
+            msg_ids = line.split()[1:]
+            if len(msg_ids) == 1:
+                more_prefix = f"BOARD READ {msg_ids[0]} "
+                out = cached_cmd(sock, f"BOARD READ {msg_ids[0]}")
+            else:
+                # Tutti i thread richiesti in un solo giro; il paging [m] vale per una lettura singola
+                more_prefix = None
+                out = [l for resp in cached_cmds(sock, [f"BOARD READ {i}" for i in msg_ids]) for l in resp]
         elif line.startswith('reply '):
             msg_id = line.split(' ', 1)[1]
             subject = input("Oggetto: ")
@@ -196,14 +542,103 @@ def board_menu(sock):
         else:
             print("Comando non valido.")
             out = []
-        
+
+        if line == 'm' or line == 'l' or line.startswith(('s ', 'r ')):
+            cursor = next_cursor(out)
+            next_page = more_prefix + cursor if cursor and more_prefix else None
+
         for r in out:
             if r.strip():
                 print(r)
 
+def chat_stream(sock):
+    """
+    Chat in modalità push: dopo CHAT SUBSCRIBE il server invia ogni nuovo messaggio
+    come riga "MSG <seq> <testo>", senza bisogno di interrogarlo periodicamente.
+    Restituisce False se il server non supporta la sottoscrizione.
+    """
+    chat_lines = deque(maxlen=30)
+    last_seq = 0
+    resp = send_cmd(sock, "CHAT RECV SINCE 0")
+    for r in resp:
+        if r.startswith("OK"):
+            seq = r[2:].strip()
+            if seq.isdigit():
+                last_seq = int(seq)
+        elif r.strip() and not r.startswith("ERR"):
+            chat_lines.append(r)
+
+    sock.begin(f"CHAT SUBSCRIBE SINCE {last_seq}")
+    # Prima della conferma possono già arrivare messaggi: si accodano allo storico
+    while True:
+        kind, line = sock.read_message()
+        if kind == 'push':
+            chat_lines.append(line.split(' ', 2)[2])
+            continue
+        if not line.startswith("OK"):
+            return False
+        break
+
+    os.system('clear' if os.name != 'nt' else 'cls')
+    print("=== Chat Pubblica (tempo reale) ===")
+    print("Digita '/quit' per uscire, /msg <utente> <testo> per privato.")
+    for line in chat_lines:
+        print(line)
+
+    replies = queue.Queue()
+
+    def reader():
+        try:
+            while True:
+                kind, line = sock.read_message()
+                if kind == 'push':
+                    print(f"\r{line.split(' ', 2)[2]}\n> ", end='', flush=True)
+                    continue
+                replies.put(line)
+                if line.startswith("OK Unsubscribed"):
+                    return
+        except (OSError, ConnectionError):
+            replies.put(None)
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+
+    while True:
+        try:
+            msg = input("> ").strip()
+        except EOFError:
+            msg = '/quit'
+        if msg.lower() == '/quit':
+            sock.begin("CHAT UNSUBSCRIBE")
+            while True:
+                reply = replies.get()
+                if reply is None or reply.startswith("OK Unsubscribed"):
+                    break
+            t.join()
+            return True
+        elif msg.startswith('/msg '):
+            _, remainder = msg.split(' ', 1)
+            cmd = f"CHAT SENDPRIVATE {remainder}"
+        elif msg:
+            cmd = f"CHAT SEND {msg}"
+        else:
+            continue
+        sock.begin(cmd)
+        reply = replies.get()
+        if reply is None:
+            print("Connessione chiusa dal server.")
+            sys.exit(1)
+        if reply != "OK":
+            print(reply)
+
 def chat_loop(sock):
+    if chat_stream(sock):
+        return
+
+    # Server senza CHAT SUBSCRIBE: si ripiega sull'interrogazione periodica
     REFRESH_INTERVAL = 5
-    chat_lines = []
+    chat_lines = deque(maxlen=30)
+    last_seq = 0
 
     print("\n=== Chat Pubblica ===")
     print("Digita '/quit' per uscire.")
@@ -212,15 +647,17 @@ def chat_loop(sock):
     while True:
         os.system('clear' if os.name != 'nt' else 'cls')
 
-        resp = send_cmd(sock, "CHAT RECV")
-        new_lines = []
+        # Solo i messaggi arrivati dopo l'ultimo numero di sequenza già visto
+        resp = send_cmd(sock, f"CHAT RECV SINCE {last_seq}")
         for r in resp:
-            if r.startswith("OK") or r.startswith("ERR") or not r.strip():
+            if r.startswith("OK"):
+                seq = r[2:].strip()
+                if seq.isdigit():
+                    last_seq = int(seq)
+                continue
+            if r.startswith("ERR") or not r.strip():
                 continue
-            new_lines.append(r)
-        chat_lines = new_lines
-        if len(chat_lines) > 30:
-            chat_lines = chat_lines[-30:]
+            chat_lines.append(r)
 
         print("=== Chat (ultimi 30 msg) ===")
         for line in chat_lines:
@@ -238,18 +675,39 @@ def chat_loop(sock):
         time.sleep(REFRESH_INTERVAL)
 
 def pmsg_menu(sock):
+    next_page = None
     while True:
         print("\nMessaggi Privati:")
         print("[l] Lista msg non letti")
-        print("[r <id>] Leggi")
+        print("[a] Lista di tutti i messaggi")
+        if next_page:
+            print("[m] Pagina successiva")
+        print("[r <id> [<id> ...]] Leggi uno o più messaggi")
         print("[w <user>] Scrivi")
+        print("[ra] Segna tutti come letti")
+        print("[d <id> [<id> ...]] Elimina messaggi")
+        print("[dr] Elimina tutti i messaggi già letti")
         print("[back] Indietro")
 
         line = input("> ").strip()
         if line == 'back':
             return
-        elif line == 'l':
-            out = send_cmd(sock, "PMSG LIST")
+        elif line in ('l', 'a'):
+            prefix = "PMSG LIST " if line == 'l' else "PMSG LIST ALL "
+            out = send_cmd(sock, prefix.strip())
+            cursor = next_cursor(out)
+            next_page = prefix + cursor if cursor else None
+        elif line == 'm' and next_page:
+            prefix = next_page.rsplit(' ', 1)[0] + ' '
+            out = send_cmd(sock, next_page)
+            cursor = next_cursor(out)
+            next_page = prefix + cursor if cursor else None
+        elif line == 'ra':
+            out = send_cmd(sock, "PMSG READALL")
+        elif line == 'dr':
+            out = send_cmd(sock, "PMSG DELETE READ")
+        elif line.startswith('d '):
+            out = send_cmd(sock, f"PMSG DELETE {line.split(' ', 1)[1]}")
         elif line.startswith('r '):
             pid = line.split(' ', 1)[1]
             out = send_cmd(sock, f"PMSG READ {pid}")
@@ -271,19 +729,129 @@ def pmsg_menu(sock):
             if r.strip():
                 print(r)
 
+def transfer_retry(sock, what):
+    print(f"Connessione persa durante {what}, riconnessione in corso...")
+    if not sock.reconnect():
+        print("Impossibile riconnettersi al server.")
+        sys.exit(1)
+
+def upload_file(sock, path, desc, vis, attempts=5):
+    """
+    FILE PUT: il server risponde con l'offset già ricevuto (0 per un upload
+    nuovo, di più se un tentativo precedente si era interrotto) e si invia il resto.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        return [f"ERR {e}"]
+    name = os.path.basename(path)
+    # Con lo sha256 il server registra subito un contenuto che ha già, senza trasferirlo
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    sha = h.hexdigest()
+    for _ in range(attempts):
+        try:
+            reqid = sock.begin(f"FILE PUT {size}|{name}|{desc}|{vis}|{sha}")
+            resp = sock.reply(reqid).strip()
+            if not resp.startswith("OK READY"):
+                return [resp]
+            offset = int(resp.split()[2])
+            if offset:
+                print(f"Ripresa dell'upload da {offset}/{size} byte")
+            with open(path, 'rb') as f:
+                if size > offset:
+                    sock.sendfile(f, offset, size - offset)
+            return [sock.reply(reqid).strip()]
+        except (OSError, ConnectionError):
+            transfer_retry(sock, "l'upload")
+    return ["ERR Upload non completato"]
+
+def parse_info(resp):
+    """Righe di FILE INFO -> {'File': ..., 'Size': ..., 'SHA256': ...}; vuoto se la risposta è ERR."""
+    info = {}
+    for r in resp:
+        if r.startswith("ERR"):
+            return {}
+        if r.startswith("ID:") and " File:" in r:
+            info['File'] = r.split(" File:", 1)[1]
+        else:
+            key, sep, value = r.partition(':')
+            if sep:
+                info.setdefault(key, value)
+    return info
+
+def download_file(sock, fid, dest, info_resp=None, attempts=5):
+    """
+    FILE GET in dest + '.part': dopo un'interruzione si chiede solo la parte mancante.
+    Il file prende il nome dest solo se dimensione e sha256 coincidono con FILE INFO.
+    """
+    if os.path.exists(dest):
+        return [f"ERR {dest} esiste già, indicare un'altra destinazione"]
+    if info_resp is None:
+        info_resp = send_cmd(sock, f"FILE INFO {fid}")
+    info = parse_info(info_resp)
+    if not info:
+        return [r for r in info_resp if r.strip()][-1:] or ["ERR Risposta non valida"]
+    if 'SHA256' not in info:
+        return ["ERR Il file non ha ancora un contenuto"]
+    size, sha = int(info['Size']), info['SHA256']
+    part = dest + '.part'
+    for _ in range(attempts):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > size:
+            offset = 0
+        try:
+            reqid = sock.begin(f"FILE GET {fid} {offset}")
+            if reqid is not None:
+                sock.reply_length(reqid)   # v2: il frame contiene la riga di stato e i byte del file
+            resp = sock.readline()
+            if not resp.startswith("OK DATA"):
+                return [resp]
+            total, offset, count = (int(x) for x in resp.split()[2:5])
+            with open(part, 'r+b' if os.path.exists(part) else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                while count > 0:
+                    data = sock.recv(min(count, 256 * 1024))
+                    if not data:
+                        raise ConnectionError("Connessione chiusa dal server")
+                    f.write(data)
+                    count -= len(data)
+            break
+        except (OSError, ConnectionError):
+            transfer_retry(sock, "il download")
+    else:
+        return [f"ERR Download non completato (riprendere con lo stesso comando, parziale in {part})"]
+
+    h = hashlib.sha256()
+    with open(part, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    if os.path.getsize(part) != size or h.hexdigest() != sha:
+        # Parziale di un altro file o dati corrotti: si riparte da zero al prossimo tentativo
+        os.remove(part)
+        return ["ERR Il contenuto scaricato non corrisponde a FILE INFO, ripetere il download"]
+    os.replace(part, dest)
+    return [f"OK Scaricati {total} byte in {dest}"]
+
 def file_menu(sock):
     while True:
         print("\nArchivio File:")
         print("[l] Lista")
         print("[info <id>] Info file")
         print("[register <filename> \"descr\" public|private] Registra file")
+        print("[put <percorso locale> \"descr\" public|private] Carica file")
+        print("[get <id> [destinazione]] Scarica file")
+        print("[del <id>] Elimina file")
         print("[back] Indietro")
 
         line = input("> ").strip()
         if line == 'back':
             return
         elif line == 'l':
-            out = send_cmd(sock, "FILE LIST")
+            out = cached_cmd(sock, "FILE LIST")
         elif line.startswith('info '):
             fid = line.split(' ', 1)[1]
             out = send_cmd(sock, f"FILE INFO {fid}")
@@ -302,6 +870,27 @@ def file_menu(sock):
                     desc = m.group(1)
                     vis = m.group(2)
                     out = send_cmd(sock, f"FILE REGISTER {filename}|{desc}|{vis}")
+        elif line.startswith('put '):
+            import re
+            m = re.match(r'^put\s+(\S+)\s+"([^"]+)"\s+(public|private)$', line)
+            if not m:
+                out = ["ERR Uso: put <percorso locale> \"descr\" public|private"]
+            else:
+                out = upload_file(sock, m.group(1), m.group(2), m.group(3))
+        elif line.startswith('get '):
+            parts = line.split()
+            if len(parts) < 2:
+                out = ["ERR Uso: get <id> [destinazione]"]
+            else:
+                info_resp = send_cmd(sock, f"FILE INFO {parts[1]}")
+                name = parse_info(info_resp).get('File')
+                if len(parts) > 2:
+                    dest = parts[2]
+                else:
+                    dest = os.path.basename(name) if name else f"file_{parts[1]}"
+                out = download_file(sock, parts[1], dest, info_resp)
+        elif line.startswith('del '):
+            out = send_cmd(sock, f"FILE DELETE {line.split(' ', 1)[1].strip()}")
         else:
             out = ["ERR Comando non valido"]
 
@@ -310,20 +899,33 @@ def file_menu(sock):
                 print(r)
 
 def text_menu(sock):
+    next_page = None
     while True:
         print("\nArchivio Testuale:")
         print("[l] Lista documenti")
         print("[r <filename>] Leggi documento")
+        print("[s <testo>] Cerca nei documenti")
+        if next_page:
+            print("[m] Pagina successiva")
         print("[back] Indietro")
 
         line = input("> ").strip()
         if line == 'back':
             return
         elif line == 'l':
-            out = send_cmd(sock, "TEXT LIST")
+            out = cached_cmd(sock, "TEXT LIST")
         elif line.startswith('r '):
-            fn = line.split(' ', 1)[1]
-            out = send_cmd(sock, f"TEXT READ {fn}")
+            fn = line.split(' ', 1)[1].strip()
+            out = cached_cmd(sock, f"TEXT READ {fn}")
+            cursor = next_cursor(out)
+            next_page = f"TEXT READ {fn} {cursor}" if cursor else None
+        elif line.startswith('s '):
+            out = send_cmd(sock, f"TEXT SEARCH {line[2:].strip()}")
+        elif line == 'm' and next_page:
+            fn_prefix = next_page.rsplit(' ', 1)[0]
+            out = cached_cmd(sock, next_page)
+            cursor = next_cursor(out)
+            next_page = f"{fn_prefix} {cursor}" if cursor else None
         else:
             out = ["ERR Comando non valido"]
         
@@ -349,38 +951,40 @@ def main():
     parser = argparse.ArgumentParser(description="Client BBS Testuale")
     parser.add_argument('--host', type=str, default=DEFAULT_HOST)
     parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--compress', action='store_true',
+                        help="comprime i dati scambiati col server (utile su linee lente)")
     args = parser.parse_args()
 
     # Connetti al server
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((args.host, args.port))
+        sock = BBSConnection(args.host, args.port, compress=args.compress)
     except Exception as e:
         print(f"Impossibile connettersi al server: {e}")
         sys.exit(1)
 
-    f = sock.makefile('r')
-    line = f.readline()
-    if not line.startswith("OK"):
-        print("Server non pronto.")
-        sys.exit(1)
-
-    # Login
+    # Login (il token ricevuto serve a riprendere la sessione se la linea cade)
     user = input("Username BBS: ")
     pw = getpass.getpass("Password BBS: ")
-    sock.sendall(f"LOGIN {user} {pw}\n".encode('utf-8'))
-    resp = f.readline().strip()
-    if resp.startswith("ERR"):
-        print("Credenziali non valide.")
+    if not sock.login(user, pw):
+        if sock.login_error.startswith("ERR Invalid credentials"):
+            print("Credenziali non valide.")
+        elif sock.login_error.startswith("ERR BUSY"):
+            print("Server occupato, riprovare più tardi.")
+        else:
+            print(f"Login non riuscito: {sock.login_error}")
         sys.exit(1)
     print("Login effettuato.")
 
-    # Determina se l'utente è admin
-    role = get_role(sock)
+    # Ruolo e messaggi non letti in un solo giro
+    role_resp, unread_resp = send_cmds(sock, ["ROLE", "PMSG UNREAD"])
+    role = next((r.split(' ', 1)[1] for r in role_resp if r.startswith("OK ")), "user")  # "admin" o "user"
     if role == 'admin':
         print("Sei connesso come admin!")
     else:
         print("Sei connesso come utente (non-admin).")
+    unread = unread_resp[0].split() if unread_resp else []
+    if len(unread) == 2 and unread[0] == "OK" and unread[1].isdigit() and int(unread[1]) > 0:
+        print(f"Hai {unread[1]} messaggi privati non letti.")
 
     main_menu(sock, role)
 
@@ -1,217 +1,337 @@
 #!/usr/bin/env python3
 import os
 import sys
+import socket
 import sqlite3
 import bcrypt
-import time
-import threading
-import socket
+import asyncio
 import argparse
 import logging
 
+from modules.db import Database
 from modules.users import UsersManager
 from modules.board import BoardManager
 from modules.chat import ChatManager
-from modules.files import FilesManager
-from modules.textlib import TextLib
+from modules.files import FilesManager, UPLOAD_DIR
+from modules.textlib import TextLib, DOCS_DIR
+from modules.aioserver import AsyncBBSServer
+from modules.stats import Stats, command_key
+from modules.revisions import Revisions
+from modules.ratelimit import RateLimiter, parse_rates, MAX_HEAVY
+from modules.sessions import SessionRegistry, SessionLimit, MAX_SESSIONS, MAX_SESSIONS_PER_USER
+from modules.logconfig import setup_logging, parse_levels, CMD_LOGGER, LOG_MAX_BYTES, LOG_BACKUPS
 
 HOST = '0.0.0.0'
 PORT = 12345
+DB_PATH = '/opt/mybbs/data/database.db'
+MAX_CONNECTIONS = 2000          # connessioni simultanee accettate
+LISTEN_BACKLOG = 512            # coda di accept del kernel
+WORKER_THREADS = 32             # thread che eseguono i comandi
+READ_BUFFER_LIMIT = 64 * 1024   # lunghezza massima di una riga di comando
+WRITE_BUFFER_HIGH = 256 * 1024  # oltre questa soglia si attende che il client legga
+WRITE_BATCH_SIZE = 64           # scritture massime per transazione di gruppo
+WRITE_MAX_DELAY = 0.005         # attesa massima (s) per riempire un lotto
+IDLE_TIMEOUT = 1800             # secondi senza comandi dopo cui una connessione autenticata viene chiusa
+LOGIN_TIMEOUT = 120             # lo stesso per le connessioni che non hanno ancora fatto login
 
 LOG_FILE = '/opt/mybbs/bbs_server.log'
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+ADMIN_SOCKET = '/opt/mybbs/bbs_server.sock'
+ADMIN_TIMEOUT = 600             # secondi di attesa per una risposta dal socket admin (backup lunghi)
+
+auth_log = logging.getLogger('bbs.auth')
+cmd_log = logging.getLogger(CMD_LOGGER)
+
+# Comandi i cui argomenti contengono segreti (password, token di sessione)
+SECRET_COMMANDS = ('LOGIN', 'RESUME', 'PASSWD')
+
+def redact(line):
+    """Riga di comando da scrivere nel log, senza password né token."""
+    parts = line.split(' ', 2)
+    cmd = parts[0].upper()
+    if cmd == 'LOGIN' and len(parts) > 1:
+        return f"LOGIN {parts[1]} ***"
+    if cmd == 'ADMIN' and len(parts) > 2 and parts[1].lower().startswith('adduser'):
+        # ADMIN adduser <username> [password]
+        return f"ADMIN {parts[1]} {parts[2].split(' ', 1)[0]} ***"
+    if cmd in SECRET_COMMANDS:
+        return f"{cmd} ***"
+    return line
+
+# Comandi il cui ultimo campo, dopo n separatori '|', è un testo che può andare su più righe
+MULTILINE_COMMANDS = {'BOARD NEW': 1, 'BOARD REPLY': 2, 'PMSG WRITE': 1}
+
+def single_line_fields(line):
+    """
+    Un frame v2 può contenere degli a capo: restano solo nel corpo di post e
+    messaggi privati. Negli altri campi (oggetti, testi della chat, nomi di file)
+    diventano spazi, perché finirebbero in risposte e MSG lette riga per riga.
+    """
+    fields = MULTILINE_COMMANDS.get(command_key(line))
+    parts = line.split('|', fields) if fields else []
+    if len(parts) <= (fields or 0):
+        return ' '.join(line.splitlines())
+    head = ' '.join('|'.join(parts[:fields]).splitlines())
+    return head + '|' + '\n'.join(parts[fields].splitlines())
 
 class BBSServer:
-    def __init__(self, db_path='/opt/mybbs/data/database.db'):
+    def __init__(self, db_path=DB_PATH, write_batch=WRITE_BATCH_SIZE, write_delay=WRITE_MAX_DELAY,
+                 docs_dir=DOCS_DIR, upload_dir=UPLOAD_DIR,
+                 max_sessions=MAX_SESSIONS, max_sessions_per_user=MAX_SESSIONS_PER_USER):
         self.db_path = db_path
         try:
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.conn.row_factory = sqlite3.Row
-            logging.info("Connessione al database SQLite stabilita.")
+            self.db = Database(self.db_path, batch_size=write_batch, max_delay=write_delay)
+            logging.info("Connessione al database SQLite stabilita (WAL).")
         except sqlite3.Error as e:
             logging.error(f"Errore connessione DB: {e}")
             sys.exit(1)
-        
-        self.users = UsersManager(self.conn)
-        self.board = BoardManager(self.conn)
-        self.chat = ChatManager(self.conn)
-        self.files = FilesManager(self.conn)
-        self.textlib = TextLib('/opt/mybbs/data/docs')
-
-        self.sessions = {}  # session_id -> {"user_id":..., "username":...}
-        self.session_counter = 0
-        self.running = True
 
-    def start_socket(self):
-        try:
-            self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_sock.bind((HOST, PORT))
-            self.server_sock.listen(5)
-            logging.info(f"BBS Server in ascolto su {HOST}:{PORT}")
-            threading.Thread(target=self.accept_loop, daemon=True).start()
-        except Exception as e:
-            logging.error(f"Errore avvio socket: {e}")
-            sys.exit(1)
-
-    def accept_loop(self):
-        while self.running:
+        self.users = UsersManager(self.db)
+        # Revisioni di bacheca, file e documenti per le richieste IFNEWER
+        self.revisions = Revisions()
+        self.board = BoardManager(self.db, self.users.directory, self.revisions)
+        self.chat = ChatManager(self.db, self.users.directory)
+        self.files = FilesManager(self.db, self.users.directory, self.revisions, upload_dir=upload_dir)
+        # L'indice dei documenti sta accanto al database
+        self.textlib = TextLib(docs_dir, revisions=self.revisions,
+                               index_path=os.path.join(os.path.dirname(os.path.abspath(db_path)), 'textindex.db'))
+
+        self.sessions = SessionRegistry(max_sessions, max_sessions_per_user)
+        self.running = True
+        self.net = None
+        self.stats = Stats(gauges=self.gauges)
+
+    def gauges(self):
+        """Valori istantanei riportati da ADMIN STATS."""
+        log_dropped = sum(getattr(h, 'dropped', 0) for h in logging.getLogger().handlers)
+        gauges = {
+            'connections': self.net.connections if self.net else 0,
+            'sessions': len(self.sessions),
+            'chat_subscribers': len(self.chat.subscribers),
+            'idle_closed': self.net.idle_closed if self.net else 0,
+            'push_dropped': self.net.push_dropped if self.net else 0,
+            'transfers': len(self.net.transfers) if self.net else 0,
+            'db_write_queue': self.db.write_queue.qsize(),
+            'text_cache_bytes': self.textlib.cache_used,
+            'log_dropped': log_dropped,
+        }
+        if self.net:
+            gauges.update(self.net.compress_stats.gauges())
+            if self.net.limiter is not None:
+                gauges.update(self.net.limiter.gauges())
+        return gauges
+
+    def process_line(self, ctx, line):
+        """
+        Elabora una singola riga di comando del protocollo e restituisce la risposta.
+        ctx contiene lo stato della connessione: addr, session_id, user_id.
+        """
+        addr = ctx['addr']
+        session_id = ctx['session_id']
+        user_id = ctx['user_id']
+
+        if '\n' in line or '\r' in line:
+            line = single_line_fields(line)
+        if cmd_log.isEnabledFor(logging.DEBUG):
+            cmd_log.debug(f"[{addr}] -> Comando: {redact(line)}")
+        parts = line.split(' ', 2)
+        cmd = parts[0].upper()
+
+        if cmd == 'LOGIN':
+            if len(parts) < 3:
+                return "ERR Missing args\n"
+            username, pw = parts[1], parts[2]
+            if self.sessions.full() and session_id is None:
+                # Inutile spendere un bcrypt per una sessione che non si potrebbe aprire
+                return "ERR Too many sessions, try later\n"
+            uid = self.users.authenticate(username, pw)
+            if not uid:
+                return "ERR Invalid credentials\n"
             try:
-                client, addr = self.server_sock.accept()
-                logging.info(f"Connessione accettata da {addr}")
-                threading.Thread(target=self.handle_client, args=(client, addr), daemon=True).start()
-            except Exception as e:
-                logging.error(f"Errore accettando connessione: {e}")
-
-    def handle_client(self, client, addr):
-        session_id = None
-        user_id = None
-        f = client.makefile('r')
-        out = client.makefile('w')
-
+                self.open_session(ctx, uid, username)
+            except SessionLimit as e:
+                auth_log.warning(f"[{addr}] Login di '{username}' rifiutato: {e}")
+                return f"ERR {e}\n"
+            token = self.users.create_session(uid)
+            ctx['token'] = token
+            self.sessions.bind_token(ctx['session_id'], token)
+            if token:
+                return f"OK Logged in {token}\n"
+            return "OK Logged in\n"
+
+        elif cmd == 'RESUME':
+            # RESUME <token>: riprende la sessione dopo una riconnessione, senza bcrypt
+            if len(parts) < 2:
+                return "ERR Missing args\n"
+            token = parts[1]
+            found = self.users.resume_session(token)
+            if not found:
+                return "ERR Invalid token\n"
+            uid, username = found
+            try:
+                self.open_session(ctx, uid, username, token)
+            except SessionLimit as e:
+                auth_log.warning(f"[{addr}] Ripresa della sessione di '{username}' rifiutata: {e}")
+                return f"ERR {e}\n"
+            return f"OK Resumed {username}\n"
+
+        elif cmd == 'LOGOUT':
+            if ctx.get('token'):
+                self.users.revoke_session(ctx['token'])
+            self.disconnect(ctx)
+            auth_log.info(f"[{addr}] Logout session_id={session_id}")
+            return "OK Logged out\n"
+
+        elif cmd == 'ROLE':
+            # Fornisce il ruolo dell'utente
+            if user_id is None:
+                return "ERR Not logged in\n"
+            role = self.users.get_role(user_id)
+            return f"OK {role}\n"
+
+        elif user_id is None:
+            return "ERR Not logged in\n"
+
+        # Utente autenticato
         try:
-            out.write("OK BBS READY\n")
-            out.flush()
-
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-
-                logging.debug(f"[{addr}] -> Comando: {line}")
-                parts = line.split(' ', 2)
-                cmd = parts[0].upper()
-
-                if cmd == 'LOGIN':
-                    if len(parts) < 3:
-                        out.write("ERR Missing args\n")
-                    else:
-                        username, pw = parts[1], parts[2]
-                        uid = self.users.authenticate(username, pw)
-                        if uid:
-                            self.session_counter += 1
-                            session_id = self.session_counter
-                            self.sessions[session_id] = {'user_id': uid, 'username': username}
-                            user_id = uid
-                            out.write("OK Logged in\n")
-                            logging.info(f"[{addr}] Utente '{username}' -> session_id={session_id}")
-                        else:
-                            out.write("ERR Invalid credentials\n")
-
-                elif cmd == 'LOGOUT':
-                    if session_id in self.sessions:
-                        del self.sessions[session_id]
-                        logging.info(f"[{addr}] Logout session_id={session_id}")
-                    out.write("OK Logged out\n")
-                    session_id = None
-                    user_id = None
-
-                elif cmd == 'ROLE':
-                    # Fornisce il ruolo dell'utente
-                    if user_id is None:
-                        out.write("ERR Not logged in\n")
-                    else:
-                        role = self.users.get_role(user_id)
-                        out.write(f"OK {role}\n")
-
-                elif user_id is None:
-                    out.write("ERR Not logged in\n")
-
-                else:
-                    # Utente autenticato
-                    try:
-                        if cmd == 'BOARD':
-                            scmd = parts[1].upper() if len(parts) > 1 else ''
-                            arg = parts[2] if len(parts) > 2 else None
-                            response = self.board.handle_command(scmd, arg, user_id)
-                            out.write(response)
-
-                        elif cmd == 'PMSG':
-                            scmd = parts[1].upper() if len(parts) > 1 else ''
-                            arg = parts[2] if len(parts) > 2 else ''
-                            response = self.users.handle_private_message(f"{scmd} {arg}", user_id)
-                            out.write(response)
-
-                        elif cmd == 'FILE':
-                            subcmd_line = parts[1] if len(parts) > 1 else ''
-                            response = self.files.handle_command(subcmd_line, user_id)
-                            out.write(response)
-
-                        elif cmd == 'TEXT':
-                            if len(parts) < 2:
-                                out.write("ERR Missing subcommand\n")
-                            else:
-                                subcmd_line = ' '.join(parts[1:])
-                                response = self.textlib.handle_command(subcmd_line)
-                                out.write(response)
-
-                        elif cmd == 'CHAT':
-                            if len(parts) > 1:
-                                subcmd_line = ' '.join(parts[1:])
-                            else:
-                                subcmd_line = ''
-                            response = self.chat.handle_command(subcmd_line, user_id)
-                            out.write(response)
-
-                        elif cmd == 'ADMIN':
-                            role = self.users.get_role(user_id)
-                            if role != 'admin':
-                                out.write("ERR Not admin\n")
-                            else:
-                                subcmd_line = parts[1] if len(parts) > 1 else ''
-                                response = self.users.handle_admin_command(subcmd_line)
-                                out.write(response)
-
-                        elif cmd == 'PASSWD':
-                            if len(parts) < 2:
-                                out.write("ERR Missing args\n")
-                            else:
-                                arg = parts[1]
-                                resp = self.users.change_password(user_id, arg)
-                                out.write(resp)
-
-                        elif cmd == 'WHO':
-                            out.write(self.list_connected_users())
-
-                        elif cmd == 'WHOAMI':
-                            uname = self.sessions[session_id]['username']
-                            out.write(f"OK {uname}\n")
-
-                        else:
-                            out.write("ERR Unknown command\n")
-
-                    except Exception as e:
-                        logging.error(f"Errore elaborando '{line}' user_id={user_id}: {e}")
-                        out.write("ERR Server error\n")
-
-                out.flush()
+            if cmd == 'BOARD':
+                scmd = parts[1].upper() if len(parts) > 1 else ''
+                arg = parts[2] if len(parts) > 2 else None
+                return self.board.handle_command(scmd, arg, user_id)
+
+            elif cmd == 'PMSG':
+                scmd = parts[1].upper() if len(parts) > 1 else ''
+                arg = parts[2] if len(parts) > 2 else ''
+                return self.users.handle_private_message(f"{scmd} {arg}", user_id)
+
+            elif cmd == 'FILE':
+                subcmd_line = ' '.join(parts[1:])
+                return self.files.handle_command(subcmd_line, user_id)
+
+            elif cmd == 'TEXT':
+                if len(parts) < 2:
+                    return "ERR Missing subcommand\n"
+                subcmd_line = ' '.join(parts[1:])
+                return self.textlib.handle_command(subcmd_line)
+
+            elif cmd == 'CHAT':
+                subcmd_line = ' '.join(parts[1:])
+                return self.chat.handle_command(subcmd_line, user_id, ctx)
+
+            elif cmd == 'ADMIN':
+                role = self.users.get_role(user_id)
+                if role != 'admin':
+                    return "ERR Not admin\n"
+                subcmd_line = ' '.join(parts[1:])
+                return self.admin_command(subcmd_line)
+
+            elif cmd == 'PASSWD':
+                if len(parts) < 2:
+                    return "ERR Missing args\n"
+                arg = ' '.join(parts[1:])
+                return self.users.change_password(user_id, arg)
+
+            elif cmd == 'WHO':
+                return self.sessions.who()
+
+            elif cmd == 'WHOAMI':
+                return f"OK {self.sessions.get(session_id).username}\n"
+
+            else:
+                return "ERR Unknown command\n"
 
         except Exception as e:
-            logging.error(f"Errore generico con {addr}: {e}")
-        finally:
-            if session_id and session_id in self.sessions:
-                del self.sessions[session_id]
-                logging.info(f"[{addr}] session_id={session_id} -> disconnessione.")
-            client.close()
-
-    def list_connected_users(self):
-        if not self.sessions:
-            return "Nessun utente connesso.\nOK\n"
-        out = "Utenti attualmente connessi:\n"
-        for sid, info in self.sessions.items():
-            out += f"- {info['username']}\n"
-        return out + "OK\n"
+            logging.error(f"Errore elaborando '{redact(line)}' user_id={user_id}: {e}")
+            return "ERR Server error\n"
+
+    def open_session(self, ctx, uid, username, token=None):
+        """Associa una nuova sessione alla connessione; SessionLimit se si supera un limite."""
+        if ctx['session_id'] is not None:
+            # Nuovo login sulla stessa connessione: la sessione precedente si chiude
+            self.disconnect(ctx)
+        session_id, replaced = self.sessions.open(ctx['addr'], uid, username, ctx['conn_id'], token)
+        ctx['session_id'] = session_id
+        ctx['user_id'] = uid
+        ctx['token'] = token
+        auth_log.info(f"[{ctx['addr']}] Utente '{username}' -> session_id={session_id}")
+        if replaced is not None:
+            # La connessione precedente (di solito già caduta) non deve più usare la sessione
+            auth_log.info(f"[{ctx['addr']}] session_id={session_id} riprende session_id={replaced.session_id} "
+                          f"di {replaced.addr}, che viene chiusa.")
+            if self.net:
+                self.net.drop_connection(replaced.conn_id)
+
+    def disconnect(self, ctx):
+        self.chat.unsubscribe(ctx.get('conn_id'))
+        session_id = ctx['session_id']
+        if session_id and self.sessions.close(session_id):
+            auth_log.info(f"[{ctx['addr']}] session_id={session_id} -> disconnessione.")
+        ctx['session_id'] = None
+        ctx['user_id'] = None
+        ctx['token'] = None
+
+    def admin_command(self, line):
+        """Comandi di gestione: ADMIN dai client admin e socket admin locale."""
+        parts = line.split(' ', 1)
+        if parts[0].upper() == 'STATS':
+            # STATS [JSON]
+            as_json = len(parts) > 1 and parts[1].strip().upper() == 'JSON'
+            return self.stats.report(as_json)
+        return self.users.handle_admin_command(line)
+
+    def control_command(self, line):
+        logging.info(f"Socket admin: {redact('ADMIN ' + line)[6:]}")
+        return self.admin_command(line)
+
+    def serve(self, host=HOST, port=PORT, max_connections=MAX_CONNECTIONS,
+              backlog=LISTEN_BACKLOG, workers=WORKER_THREADS, admin_sock=ADMIN_SOCKET,
+              idle_timeout=IDLE_TIMEOUT, login_timeout=LOGIN_TIMEOUT, limiter=None):
+        self.net = AsyncBBSServer(
+            self, host, port,
+            max_connections=max_connections,
+            backlog=backlog,
+            workers=workers,
+            read_limit=READ_BUFFER_LIMIT,
+            write_high=WRITE_BUFFER_HIGH,
+            admin_sock=admin_sock,
+            idle_timeout=idle_timeout,
+            login_timeout=login_timeout,
+            limiter=limiter,
+        )
+        try:
+            asyncio.run(self.net.serve())
+        except OSError as e:
+            logging.error(f"Errore avvio socket: {e}")
+            sys.exit(1)
 
     def stop(self):
         self.running = False
-        self.server_sock.close()
+        if self.net is not None:
+            self.net.stop()
+        self.db.close()
+        self.textlib.index.close()
         logging.info("BBS Server fermato.")
 
+def send_admin(sock_path, line, timeout=ADMIN_TIMEOUT):
+    """
+    Invia un comando di gestione al server in esecuzione tramite il socket admin.
+    Restituisce la risposta, o None se nessun server è in ascolto.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(sock_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
+        return None
+    with s, s.makefile('r', encoding='utf-8') as f:
+        s.sendall((line + "\n").encode('utf-8'))
+        out = ""
+        for resp in f:
+            out += resp
+            if resp.startswith("OK") or resp.startswith("ERR"):
+                break
+        return out
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Server BBS Testuale",
@@ -225,64 +345,119 @@ if __name__ == "__main__":
     parser.add_argument('--listusers', action='store_true', help='Lista degli utenti registrati')
     parser.add_argument('--backup', nargs='?', const='/opt/mybbs/data/database_backup.db', default=None,
                         help='Backup del database (percorso opzionale)')
+    parser.add_argument('--backup-compress', action='store_true', help='Comprime il backup con gzip')
+    parser.add_argument('--backup-keep', type=int, default=0,
+                        help='Backup precedenti da conservare ruotandoli in <file>.1 ... <file>.N')
+    parser.add_argument('--host', default=HOST, help='Indirizzo di ascolto')
+    parser.add_argument('--port', type=int, default=PORT, help='Porta TCP di ascolto')
+    parser.add_argument('--db', default=DB_PATH, help='Database SQLite')
+    parser.add_argument('--docs-dir', default=DOCS_DIR, help='Cartella dei documenti testuali')
+    parser.add_argument('--upload-dir', default=UPLOAD_DIR, help='Cartella dei file caricati')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='Numero massimo di connessioni simultanee')
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                        help='Sessioni autenticate simultanee massime')
+    parser.add_argument('--max-sessions-per-user', type=int, default=MAX_SESSIONS_PER_USER,
+                        help='Sessioni simultanee massime per utente')
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT,
+                        help='Secondi di inattività dopo cui una connessione viene chiusa (0 = mai)')
+    parser.add_argument('--login-timeout', type=int, default=LOGIN_TIMEOUT,
+                        help='Secondi concessi a una nuova connessione per fare login (0 = nessun limite)')
+    parser.add_argument('--rate-session', default='',
+                        help='Limiti per connessione, classe=token_al_secondo/capienza (classi: auth, write, heavy, read; 0 = nessun limite)')
+    parser.add_argument('--rate-user', default='',
+                        help='Limiti per utente, stesso formato di --rate-session')
+    parser.add_argument('--max-heavy', type=int, default=MAX_HEAVY,
+                        help='Comandi costosi (login, ricerche, backup) in esecuzione contemporaneamente (0 = nessun tetto)')
+    parser.add_argument('--no-rate-limit', action='store_true', help='Disattiva limiti di frequenza e tetto dei comandi costosi')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help='Lunghezza della coda di accept')
+    parser.add_argument('--workers', type=int, default=WORKER_THREADS,
+                        help='Thread del pool che esegue i comandi')
+    parser.add_argument('--write-batch', type=int, default=WRITE_BATCH_SIZE,
+                        help='Scritture massime per commit di gruppo')
+    parser.add_argument('--write-delay', type=float, default=WRITE_MAX_DELAY,
+                        help='Attesa massima in secondi per riempire un commit di gruppo')
+    parser.add_argument('--admin-sock', default=ADMIN_SOCKET,
+                        help='Socket Unix per i comandi di gestione locali')
+    parser.add_argument('--log-file', default=LOG_FILE, help='File di log')
+    parser.add_argument('--log-level', default='DEBUG', help='Livello di log generale')
+    parser.add_argument('--log-levels', default='',
+                        help='Livelli per sottosistema, es. net=INFO,auth=DEBUG,board=WARNING,chat=INFO')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='Registra una riga di debug dei comandi ogni N (0 = nessuna)')
+    parser.add_argument('--log-max-bytes', type=int, default=LOG_MAX_BYTES,
+                        help='Dimensione oltre la quale il log viene ruotato')
+    parser.add_argument('--log-backups', type=int, default=LOG_BACKUPS,
+                        help='Numero di file di log ruotati da conservare')
     args = parser.parse_args()
 
-    server = BBSServer()
+    try:
+        setup_logging(args.log_file, level=args.log_level.upper(), levels=parse_levels(args.log_levels),
+                      sample=args.log_sample, max_bytes=args.log_max_bytes, backups=args.log_backups)
+    except ValueError as e:
+        parser.error(str(e))
+    limiter = None
+    if not args.no_rate_limit:
+        try:
+            limiter = RateLimiter(parse_rates(args.rate_session), parse_rates(args.rate_user), args.max_heavy)
+        except ValueError as e:
+            parser.error(str(e))
 
-    # Comandi admin da riga di comando
+    # Comandi admin da riga di comando: stessi comandi di ADMIN
+    admin_line = None
     if args.adduser:
         import getpass
         pw = getpass.getpass(f"Inserire password per l'utente admin '{args.adduser}': ")
-        server.users.add_user(args.adduser, pw, role='admin')
-        print(f"Utente admin '{args.adduser}' creato.")
-        sys.exit(0)
-
-    if args.adduser_nonadmin:
+        admin_line = f"adduser {args.adduser} {pw}"
+    elif args.adduser_nonadmin:
         import getpass
         pw = getpass.getpass(f"Inserire password per l'utente '{args.adduser_nonadmin}': ")
-        server.users.add_user(args.adduser_nonadmin, pw, role='user')
-        print(f"Utente '{args.adduser_nonadmin}' creato (non-admin).")
-        sys.exit(0)
-
-    if args.deluser:
-        server.users.delete_user(args.deluser)
-        print(f"Utente '{args.deluser}' rimosso.")
-        sys.exit(0)
-
-    if args.promote:
-        server.users.promote_user(args.promote)
-        print(f"Utente '{args.promote}' promosso a admin.")
-        sys.exit(0)
-
-    if args.demote:
-        server.users.demote_user(args.demote)
-        print(f"Utente '{args.demote}' revocato da admin.")
-        sys.exit(0)
-
-    if args.listusers:
-        users = server.users.list_users()
-        if users:
-            print("Lista utenti registrati:")
-            for u in users:
-                print(f" - {u['username']} ({u['role']})")
-        sys.exit(0)
-
-    if args.backup is not None:
-        backup_path = args.backup
-        ok = server.users.backup_database(backup_path)
-        if ok:
-            print(f"Backup DB effettuato in '{backup_path}'")
-        else:
-            print("Backup DB fallito.")
-        sys.exit(0)
+        admin_line = f"adduser-nonadmin {args.adduser_nonadmin} {pw}"
+    elif args.deluser:
+        admin_line = f"deluser {args.deluser}"
+    elif args.promote:
+        admin_line = f"promote {args.promote}"
+    elif args.demote:
+        admin_line = f"demote {args.demote}"
+    elif args.listusers:
+        admin_line = "listusers"
+    elif args.backup is not None:
+        admin_line = f"backup {args.backup}"
+        if args.backup_compress:
+            admin_line += " gz"
+        if args.backup_keep > 0:
+            admin_line += f" keep={args.backup_keep}"
+
+    if admin_line is not None:
+        # Con il server avviato si passa dal suo socket admin, senza aprire il database
+        try:
+            out = send_admin(args.admin_sock, admin_line)
+        except OSError as e:
+            print(f"Socket admin {args.admin_sock} non utilizzabile: {e}")
+            sys.exit(1)
+        if out is None:
+            # Nessun server in esecuzione: accesso diretto al database
+            server = BBSServer(args.db, write_batch=args.write_batch, write_delay=args.write_delay,
+                               docs_dir=args.docs_dir, upload_dir=args.upload_dir)
+            out = server.admin_command(admin_line)
+            server.db.close()
+            server.textlib.index.close()
+        lines = out.splitlines()
+        print("\n".join(lines))
+        sys.exit(0 if lines and lines[-1].startswith("OK") else 1)
+
+    server = BBSServer(args.db, write_batch=args.write_batch, write_delay=args.write_delay,
+                       docs_dir=args.docs_dir, upload_dir=args.upload_dir,
+                       max_sessions=args.max_sessions, max_sessions_per_user=args.max_sessions_per_user)
 
     # Avvia il server
-    server.start_socket()
     logging.info("BBS Server in esecuzione.")
     print("BBS Server in esecuzione.")
     try:
-        while True:
-            time.sleep(1)
+        server.serve(host=args.host, port=args.port, max_connections=args.max_connections,
+                     backlog=args.backlog, workers=args.workers, admin_sock=args.admin_sock,
+                     idle_timeout=args.idle_timeout, login_timeout=args.login_timeout, limiter=limiter)
     except KeyboardInterrupt:
         server.stop()
 
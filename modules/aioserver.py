@@ -0,0 +1,442 @@
+import os
+import time
+import socket
+import struct
+import asyncio
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from modules.files import Upload, Download
+from modules.stats import command_key, take_db_time
+from modules.ratelimit import command_class
+from modules.compress import COMPRESS_METHODS, CompressStats, Deflater, InflateReader
+
+log = logging.getLogger('bbs.net')
+
+TRANSFER_CHUNK = 256 * 1024
+REAP_INTERVAL = 30              # ogni quanti secondi si cercano le connessioni inattive
+KEEPALIVE_IDLE = 60             # keepalive TCP: primo probe dopo 60 s di silenzio,
+KEEPALIVE_INTERVAL = 10         # poi ogni 10 s, e dopo 5 senza risposta il kernel
+KEEPALIVE_COUNT = 5             # chiude la connessione (client spariti senza FIN)
+
+def escape_status_lines(response):
+    """
+    I client v1 leggono fino alla prima riga che inizia con OK o ERR: nel contenuto
+    (corpi dei post, documenti) queste righe ricevono uno spazio davanti.
+    """
+    end = response.rfind('\n', 0, len(response) - 1) + 1
+    body = response[:end]
+    if not (body.startswith(('OK', 'ERR')) or '\nOK' in body or '\nERR' in body):
+        return response
+    lines = body.split('\n')
+    return '\n'.join(' ' + l if l.startswith(('OK', 'ERR')) else l for l in lines) + response[end:]
+
+class AsyncBBSServer:
+    """
+    Server asyncio per il protocollo a righe del BBS.
+    Le connessioni inattive non occupano thread: solo l'elaborazione dei comandi
+    gira su un pool di worker limitato.
+    """
+    def __init__(self, bbs, host, port, max_connections=2000, backlog=512,
+                 workers=32, read_limit=64 * 1024, write_high=256 * 1024, admin_sock=None,
+                 idle_timeout=None, login_timeout=None, limiter=None):
+        self.bbs = bbs
+        self.admin_sock = admin_sock
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.read_limit = read_limit
+        self.write_high = write_high
+        self.idle_timeout = idle_timeout
+        self.login_timeout = login_timeout
+        self.limiter = limiter   # RateLimiter, None = nessun limite
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bbs-worker')
+        self.connections = 0
+        self.conn_ids = itertools.count(1)
+        self.push_dropped = 0
+        self.idle_closed = 0
+        self.clients = {}        # conn_id -> (ctx, writer), per il controllo dell'inattività
+        self.transfers = set()   # writer con un trasferimento binario in corso
+        self.compress_stats = CompressStats()
+        self.loop = None
+        self.server = None
+        self.admin_server = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            backlog=self.backlog, limit=self.read_limit, reuse_address=True
+        )
+        log.info(f"BBS Server in ascolto su {self.host}:{self.port} "
+                     f"(max_conn={self.max_connections}, backlog={self.backlog})")
+        if self.admin_sock:
+            await self.start_admin()
+        if self.idle_timeout or self.login_timeout:
+            self.loop.create_task(self.reap_idle())
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.connections >= self.max_connections:
+            log.warning(f"Connessione rifiutata da {addr}: limite di {self.max_connections} raggiunto")
+            writer.write(b"ERR Server full\n")
+            await self.close_writer(writer)
+            return
+
+        self.connections += 1
+        log.info(f"Connessione accettata da {addr}")
+        # Oltre questa soglia drain() sospende la coroutine finché il client non legge
+        writer.transport.set_write_buffer_limits(high=self.write_high)
+        self.set_keepalive(writer)
+        ctx = {
+            'addr': addr,
+            'session_id': None,
+            'user_id': None,
+            'conn_id': next(self.conn_ids),
+            'proto': 1,
+            'deflate': None,
+            'last_active': time.monotonic(),
+        }
+        ctx['push'] = self.make_push(writer, ctx)
+        self.clients[ctx['conn_id']] = (ctx, writer)
+
+        try:
+            writer.write(b"OK BBS READY\n")
+            await writer.drain()
+
+            while True:
+                # Inattiva da adesso; mentre un comando è in corso vale None e il reaper la salta
+                ctx['last_active'] = time.monotonic()
+                if ctx['proto'] == 1:
+                    try:
+                        raw = await reader.readline()
+                    except ValueError:
+                        log.warning(f"[{addr}] Riga oltre {self.read_limit} byte, chiusura.")
+                        self.write(writer, ctx, b"ERR Line too long\n")
+                        break
+                    if not raw:
+                        break
+                    reqid = None
+                    line = raw.decode('utf-8', errors='replace').strip()
+                else:
+                    # v2: "<reqid> <lunghezza>\n" seguito da esattamente <lunghezza> byte
+                    try:
+                        raw = await reader.readline()
+                        if not raw:
+                            break
+                        reqid, length = (int(x) for x in raw.split())
+                        if reqid < 1 or not 0 <= length <= self.read_limit:
+                            raise ValueError(raw)
+                        payload = await reader.readexactly(length)
+                    except asyncio.IncompleteReadError:
+                        break
+                    except ValueError:
+                        log.warning(f"[{addr}] Frame v2 non valido, chiusura.")
+                        self.write(writer, ctx, self.frame(0, b"ERR Bad frame\n"))
+                        break
+                    raw += payload
+                    line = payload.decode('utf-8', errors='replace').strip()
+                if not line:
+                    if reqid is not None:
+                        # In v2 ogni frame con un id aspetta la sua risposta
+                        self.write(writer, ctx, self.frame(reqid, b"ERR Empty command\n"))
+                        await writer.drain()
+                    continue
+                ctx['last_active'] = None
+
+                if line.upper().startswith('PROTO'):
+                    # PROTO <versione>: la risposta usa ancora la codifica corrente
+                    version = line[5:].strip()
+                    if version in ('1', '2'):
+                        self.write(writer, ctx, self.frame(reqid, f"OK PROTO {version}\n".encode('utf-8')))
+                        ctx['proto'] = int(version)
+                    else:
+                        self.write(writer, ctx, self.frame(reqid, b"ERR Unsupported protocol\n"))
+                    await writer.drain()
+                    continue
+
+                if line.upper().startswith('COMPRESS'):
+                    # COMPRESS zlib: dopo la risposta (non compressa) entrambe le direzioni
+                    # viaggiano a blocchi compressi; non si torna indietro
+                    method = line[8:].strip().lower()
+                    if ctx['deflate'] is not None:
+                        self.write(writer, ctx, self.frame(reqid, b"ERR Already compressed\n"))
+                    elif method in COMPRESS_METHODS:
+                        self.write(writer, ctx, self.frame(reqid, f"OK COMPRESS {method}\n".encode('utf-8')))
+                        ctx['deflate'] = Deflater(self.compress_stats)
+                        reader = InflateReader(reader, self.compress_stats, self.read_limit)
+                        self.compress_stats.connections += 1
+                    else:
+                        self.write(writer, ctx, self.frame(reqid, b"ERR Unsupported compression\n"))
+                    await writer.drain()
+                    continue
+
+                if self.limiter is not None:
+                    cls, retry = self.limiter.admit(ctx, line)
+                    if retry:
+                        # Rifiutato subito, senza occupare un worker: il client riprova più tardi
+                        data = self.frame(reqid, f"ERR BUSY retry-after={retry}\n".encode('utf-8'))
+                        self.write(writer, ctx, data)
+                        await writer.drain()
+                        # Non entra nelle latenze per comando: lo contano i gauge ratelimit_*
+                        continue
+                try:
+                    response, elapsed, db_time = await self.loop.run_in_executor(
+                        self.executor, self.run_command, ctx, line
+                    )
+                finally:
+                    if self.limiter is not None:
+                        self.limiter.release(cls)
+                bytes_in = len(raw)
+                if isinstance(response, Download):
+                    await self.send_file(writer, ctx, response, reqid)
+                    bytes_out = len(response.header) + response.count
+                elif isinstance(response, Upload):
+                    bytes_in += response.remaining
+                    response = await self.receive_file(reader, writer, ctx, response, reqid)
+                    bytes_out = len(response)
+                elif response:
+                    if reqid is None:
+                        response = escape_status_lines(response)
+                    data = self.frame(reqid, response.encode('utf-8'))
+                    self.write(writer, ctx, data)
+                    bytes_out = len(data)
+                    await writer.drain()
+                else:
+                    bytes_out = 0
+                self.bbs.stats.record(command_key(line), elapsed, isinstance(response, str) and
+                                      response.startswith('ERR'), db_time, bytes_in, bytes_out)
+
+        except ConnectionError as e:
+            log.info(f"[{addr}] Connessione interrotta: {e}")
+        except Exception as e:
+            log.error(f"Errore generico con {addr}: {e}")
+        finally:
+            self.connections -= 1
+            self.clients.pop(ctx['conn_id'], None)
+            if self.limiter is not None:
+                self.limiter.forget(ctx['conn_id'])
+            if ctx['deflate'] is not None:
+                self.compress_stats.connections -= 1
+            self.bbs.disconnect(ctx)
+            await self.close_writer(writer)
+
+    def drop_connection(self, conn_id):
+        """Chiude una connessione dal thread di un worker (sessione ripresa altrove)."""
+        self.loop.call_soon_threadsafe(self.close_client, conn_id)
+
+    def close_client(self, conn_id):
+        entry = self.clients.get(conn_id)
+        if entry is not None:
+            entry[1].close()
+
+    def set_keepalive(self, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Le opzioni fini non esistono su tutti i sistemi: dove mancano restano i default
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+        except OSError as e:
+            log.warning(f"Keepalive non impostato: {e}")
+
+    async def reap_idle(self):
+        """
+        Chiude le connessioni che non mandano comandi da troppo tempo: idle_timeout
+        per quelle autenticate, login_timeout per quelle che non hanno fatto login.
+        Restano aperte le connessioni iscritte alla chat (aspettano push, non
+        comandi) e quelle con un trasferimento in corso.
+        """
+        # Con timeout più brevi dell'intervallo (test, server piccoli) si controlla più spesso
+        interval = min(t for t in (REAP_INTERVAL, self.idle_timeout, self.login_timeout) if t)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for ctx, writer in list(self.clients.values()):
+                last = ctx['last_active']
+                limit = self.idle_timeout if ctx['session_id'] is not None else self.login_timeout
+                if last is None or not limit or now - last < limit:
+                    continue
+                if writer.is_closing() or writer in self.transfers or ctx['conn_id'] in self.bbs.chat.subscribers:
+                    continue
+                log.info(f"[{ctx['addr']}] Inattiva da {int(now - last)}s, chiusura.")
+                self.idle_closed += 1
+                # Nessun messaggio: una riga non richiesta confonderebbe un client v1.
+                # La coroutine della connessione riceve EOF e fa la sua pulizia.
+                writer.close()
+
+    async def start_admin(self):
+        """
+        Socket Unix per i comandi di gestione locali (bbs_server.py --listusers, ...):
+        stessi comandi di ADMIN, eseguiti con la connessione e le cache del server.
+        """
+        path = self.admin_sock
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                log.error(f"Socket admin {path} già in uso da un altro processo, non attivato")
+                return
+            except OSError:
+                os.unlink(path)   # residuo di un avvio precedente
+            finally:
+                probe.close()
+        self.admin_server = await asyncio.start_unix_server(self.handle_admin, path=path)
+        # Solo l'utente del server (e root) può connettersi
+        os.chmod(path, 0o600)
+        log.info(f"Socket admin in ascolto su {path}")
+
+    async def handle_admin(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if hasattr(socket, 'SO_PEERCRED') and sock is not None:
+            creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+            pid, uid, gid = struct.unpack('3i', creds)
+            if uid not in (0, os.getuid()):
+                log.warning(f"Socket admin: connessione rifiutata da uid={uid} pid={pid}")
+                await self.close_writer(writer)
+                return
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                line = raw.decode('utf-8', errors='replace').strip()
+                if not line:
+                    continue
+                cls = command_class('ADMIN ' + line)
+                if self.limiter is not None:
+                    self.limiter.occupy(cls)
+                try:
+                    response = await self.loop.run_in_executor(self.executor, self.bbs.control_command, line)
+                finally:
+                    if self.limiter is not None:
+                        self.limiter.release(cls)
+                writer.write(response.encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            log.info(f"Socket admin: connessione interrotta: {e}")
+        finally:
+            await self.close_writer(writer)
+
+    def frame(self, reqid, data):
+        """Protocollo v2: intestazione "<reqid> <lunghezza>"; in v1 (reqid None) i byte restano come sono."""
+        if reqid is None:
+            return data
+        return f"{reqid} {len(data)}\n".encode('ascii') + data
+
+    def write(self, writer, ctx, data):
+        """Scrive sulla connessione, passando dal compressore se il client ha chiesto COMPRESS."""
+        if ctx['deflate'] is not None:
+            data = ctx['deflate'].encode(data)
+        writer.write(data)
+
+    def run_command(self, ctx, line):
+        """Esegue il comando nel worker misurandone durata e tempo passato in SQLite."""
+        take_db_time()
+        t0 = time.perf_counter()
+        response = self.bbs.process_line(ctx, line)
+        return response, time.perf_counter() - t0, take_db_time()
+
+    async def send_file(self, writer, ctx, download, reqid=None):
+        """
+        Invia header e contenuto con loop.sendfile (os.sendfile, copia zero):
+        la coroutine attende il socket senza occupare un worker.
+        In v2 header e contenuto formano un unico frame; con COMPRESS il
+        contenuto viaggia in un blocco non compresso.
+        """
+        self.transfers.add(writer)
+        try:
+            header = download.header.encode('utf-8')
+            if reqid is not None:
+                header = f"{reqid} {len(header) + download.count}\n".encode('ascii') + header
+            self.write(writer, ctx, header)
+            if ctx['deflate'] is not None and download.count > 0:
+                writer.write(ctx['deflate'].raw_header(download.count))
+            await writer.drain()
+            if download.count > 0:
+                with open(download.path, 'rb') as f:
+                    await self.loop.sendfile(writer.transport, f, download.offset, download.count)
+        finally:
+            self.transfers.discard(writer)
+
+    async def receive_file(self, reader, writer, ctx, upload, reqid=None):
+        """
+        Legge i byte dell'upload a blocchi e li accoda al file parziale; se la
+        connessione cade il parziale resta e il prossimo FILE PUT riprende da lì.
+        """
+        try:
+            # In v2 i byte del file seguono la risposta READY senza frame: la lunghezza è già nota
+            self.write(writer, ctx, self.frame(reqid, upload.header.encode('utf-8')))
+            await writer.drain()
+            await self.loop.run_in_executor(self.executor, upload.open)
+            try:
+                remaining = upload.remaining
+                while remaining > 0:
+                    chunk = await reader.read(min(TRANSFER_CHUNK, remaining))
+                    if not chunk:
+                        raise ConnectionError(f"upload di {upload.filename} interrotto a "
+                                              f"{upload.size - remaining}/{upload.size} byte")
+                    await self.loop.run_in_executor(self.executor, upload.write, chunk)
+                    remaining -= len(chunk)
+            finally:
+                await self.loop.run_in_executor(self.executor, upload.close)
+            response = await self.loop.run_in_executor(self.executor, upload.finish)
+        finally:
+            upload.release()
+        self.write(writer, ctx, self.frame(reqid, response.encode('utf-8')))
+        await writer.drain()
+        return response
+
+    def make_push(self, writer, ctx):
+        """
+        Restituisce una funzione, richiamabile da qualunque thread, che accoda
+        byte già codificati sulla connessione (messaggi non richiesti dal client).
+        In v2 ogni messaggio viaggia in un frame con reqid 0.
+        """
+        def push(data):
+            if ctx['proto'] == 2:
+                data = self.frame(0, data)
+            self.loop.call_soon_threadsafe(self.push_data, writer, ctx, data)
+        return push
+
+    def push_data(self, writer, ctx, data):
+        if writer.is_closing():
+            return
+        if writer in self.transfers:
+            # Durante sendfile il transport non accetta altre scritture
+            self.push_dropped += 1
+            return
+        if writer.transport.get_write_buffer_size() > self.write_high:
+            # Client che non legge: il messaggio si scarta invece di accumularlo in memoria
+            self.push_dropped += 1
+            return
+        # Si comprime solo quello che parte davvero: il contesto zlib è condiviso con il client
+        self.write(writer, ctx, data)
+
+    async def close_writer(self, writer):
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+        if self.admin_server is not None:
+            self.admin_server.close()
+            try:
+                os.unlink(self.admin_sock)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,62 @@
+import os
+import hashlib
+import logging
+
+HASH_CHUNK = 1024 * 1024
+
+class BlobStore:
+    """
+    Archivio dei contenuti indirizzato per hash: ogni contenuto è salvato una
+    sola volta in <root>/<sha[:2]>/<sha>, qualunque sia il nome con cui è stato caricato.
+    I riferimenti (tabella blobs, refcount) sono gestiti da FilesManager.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def exists(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def link(self, src, sha):
+        """
+        Collega src nell'archivio sotto sha, senza toccare src: chi chiama lo
+        rimuove dopo aver registrato il blob. Restituisce True se il blob è nuovo.
+        """
+        dst = self.path(sha)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+            return True
+        except FileExistsError:
+            return False
+
+    def remove(self, sha):
+        try:
+            os.remove(self.path(sha))
+        except FileNotFoundError:
+            logging.warning(f"Blob {sha} già assente dall'archivio")
+
+    def shas(self):
+        """Tutti i contenuti presenti sul disco."""
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    if blob.is_file():
+                        yield blob.name
+
+    @staticmethod
+    def hash_file(path):
+        """sha256 e dimensione di un file, letto a blocchi."""
+        h = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+                size += len(chunk)
+        return h.hexdigest(), size
@@ -1,64 +1,241 @@
+import re
 import time
+import sqlite3
 import logging
+from modules.revisions import Revisions, split_ifnewer
+
+log = logging.getLogger('bbs.board')
+
+LIST_PAGE_SIZE = 50
+LIST_MAX_PAGE_SIZE = 500
+READ_PAGE_SIZE = 100
+READ_MAX_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
 
 class BoardManager:
-    def __init__(self, conn):
-        self.conn = conn
+    def __init__(self, db, directory, revisions=None):
+        self.db = db
+        self.directory = directory
+        self.revisions = revisions if revisions is not None else Revisions()
+        self.search_enabled = False
+        self.ensure_indexes()
+        self.ensure_search_index()
+
+    def ensure_indexes(self):
+        # (parent_id, id) copre sia l'elenco dei thread (parent_id IS NULL) sia le risposte
+        with self.db.writer() as conn:
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_board_parent
+                ON board_messages(parent_id, id)
+            """)
+
+    def ensure_search_index(self):
+        """
+        Indice FTS5 su oggetto e corpo dei messaggi, tenuto aggiornato dai trigger
+        nella stessa transazione dell'INSERT. Alla prima creazione viene popolato
+        con i messaggi già presenti.
+        """
+        try:
+            with self.db.writer() as conn:
+                exists = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='board_fts'"
+                ).fetchone()
+                conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS board_fts USING fts5(
+                        subject, body,
+                        content='board_messages', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                """)
+                conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS board_fts_ai AFTER INSERT ON board_messages BEGIN
+                        INSERT INTO board_fts(rowid, subject, body) VALUES (new.id, new.subject, new.body);
+                    END
+                """)
+                conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS board_fts_ad AFTER DELETE ON board_messages BEGIN
+                        INSERT INTO board_fts(board_fts, rowid, subject, body)
+                        VALUES ('delete', old.id, old.subject, old.body);
+                    END
+                """)
+                conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS board_fts_au AFTER UPDATE ON board_messages BEGIN
+                        INSERT INTO board_fts(board_fts, rowid, subject, body)
+                        VALUES ('delete', old.id, old.subject, old.body);
+                        INSERT INTO board_fts(rowid, subject, body) VALUES (new.id, new.subject, new.body);
+                    END
+                """)
+                if not exists:
+                    log.info("Creazione indice di ricerca della bacheca (board_fts)...")
+                    conn.execute("INSERT INTO board_fts(board_fts) VALUES ('rebuild')")
+            self.search_enabled = True
+        except sqlite3.OperationalError as e:
+            log.warning(f"FTS5 non disponibile, BOARD SEARCH disattivato: {e}")
+
+    def search_query(self, text):
+        # Ogni parola diventa un termine tra virgolette (AND implicito), così la
+        # sintassi FTS5 non arriva mai dal client; "parola*" cerca per prefisso
+        terms = re.findall(r'\w+\*?', text)
+        return ' '.join(f'"{t[:-1]}"*' if t.endswith('*') else f'"{t}"' for t in terms)
 
     def handle_command(self, cmd, arg, user_id):
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         try:
             if cmd == 'LIST':
-                c.execute("""
-                    SELECT b.id, u.username, b.timestamp, b.subject
-                    FROM board_messages b
-                    JOIN users u ON b.author_id = u.id
-                    WHERE b.parent_id IS NULL
-                    ORDER BY b.id DESC
-                """)
+                # BOARD LIST [IFNEWER <rev>] [before_id] [limit]: paginazione a chiave,
+                # dal thread più recente
+                try:
+                    since, arg = split_ifnewer(arg)
+                    args = arg.split() if arg else []
+                    before_id = int(args[0]) if len(args) > 0 else None
+                    limit = int(args[1]) if len(args) > 1 else LIST_PAGE_SIZE
+                except ValueError:
+                    return "ERR LIST [IFNEWER <rev>] [before_id] [limit]\n"
+                # La revisione si legge prima dei dati: al peggio il client rilegge una volta di troppo
+                rev = self.revisions.get('board')
+                if since is not None and rev <= since:
+                    return "OK NOTMODIFIED\n"
+                limit = max(1, min(limit, LIST_MAX_PAGE_SIZE))
+                if before_id is None:
+                    c.execute("""
+                        SELECT id, author_id, timestamp, subject
+                        FROM board_messages
+                        WHERE parent_id IS NULL
+                        ORDER BY id DESC
+                        LIMIT ?
+                    """, (limit + 1,))
+                else:
+                    c.execute("""
+                        SELECT id, author_id, timestamp, subject
+                        FROM board_messages
+                        WHERE parent_id IS NULL AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    """, (before_id, limit + 1))
                 rows = c.fetchall()
-                out = ""
+                more = len(rows) > limit
+                rows = rows[:limit]
+                users = self.directory.snapshot()[0]
+                out = []
                 for r in rows:
-                    out += f"{r['id']} [{r['subject']}] by {r['username']} at {r['timestamp']}\n"
-                return out + "OK\n"
+                    uname = users.get(r['author_id'], ('???',))[0]
+                    out.append(f"{r['id']} [{r['subject']}] by {uname} at {r['timestamp']}\n")
+                if more:
+                    # Il client richiede la pagina successiva con BOARD LIST <id>
+                    out.append(f"OK MORE {rows[-1]['id']} REV {rev}\n")
+                else:
+                    out.append(f"OK REV {rev}\n")
+                return "".join(out)
 
             elif cmd == 'READ':
-                if not arg:
-                    return "ERR Need id\n"
-                msg_id = arg.strip()
+                # BOARD READ [IFNEWER <rev>] <id> [offset] [limit]: il thread completo in ordine
+                # di visita, una pagina alla volta (offset 0 = messaggio iniziale)
+                try:
+                    since, arg = split_ifnewer(arg)
+                    args = arg.split() if arg else []
+                    if not args:
+                        return "ERR Need id\n"
+                    msg_id = int(args[0])
+                    offset = int(args[1]) if len(args) > 1 else 0
+                    limit = int(args[2]) if len(args) > 2 else READ_PAGE_SIZE
+                except ValueError:
+                    return "ERR READ [IFNEWER <rev>] <id> [offset] [limit]\n"
+                # Ogni risposta aggiorna la revisione di tutti i messaggi sopra di lei
+                rev = self.revisions.get(('thread', msg_id))
+                if since is not None and rev <= since:
+                    return "OK NOTMODIFIED\n"
+                offset = max(0, offset)
+                limit = max(1, min(limit, READ_MAX_PAGE_SIZE))
+                # Il percorso di id a larghezza fissa ordina i nodi in pre-ordine; con
+                # ORDER BY e LIMIT nel passo ricorsivo la visita si ferma a fine pagina
                 c.execute("""
-                    SELECT b.id, u.username, b.timestamp, b.subject, b.body
-                    FROM board_messages b
-                    JOIN users u ON b.author_id = u.id
-                    WHERE b.id=?
-                """, (msg_id,))
-                row = c.fetchone()
-                if not row:
+                    WITH RECURSIVE thread(id, parent_id, depth, path) AS (
+                        SELECT id, parent_id, 0, printf('%012d', id)
+                        FROM board_messages
+                        WHERE id = ?
+                        UNION ALL
+                        SELECT b.id, b.parent_id, t.depth + 1, t.path || '.' || printf('%012d', b.id)
+                        FROM board_messages b
+                        JOIN thread t ON b.parent_id = t.id
+                        ORDER BY 4
+                        LIMIT ?
+                    )
+                    SELECT t.id, t.parent_id, t.depth, b.author_id, b.timestamp, b.subject, b.body
+                    FROM thread t
+                    JOIN board_messages b ON b.id = t.id
+                    ORDER BY t.path
+                    LIMIT ? OFFSET ?
+                """, (msg_id, offset + limit + 1, limit + 1, offset))
+                rows = c.fetchall()
+                if not rows and offset == 0:
                     return "ERR Not found\n"
-                out = f"ID:{row['id']} Subject:{row['subject']}\nAuthor:{row['username']} At:{row['timestamp']}\n{row['body']}\n"
-                # Leggi eventuali reply
+                more = len(rows) > limit
+                users = self.directory.snapshot()[0]
+                out = []
+                for r in rows[:limit]:
+                    uname = users.get(r['author_id'], ('???',))[0]
+                    if r['depth'] == 0:
+                        out.append(f"ID:{r['id']} Subject:{r['subject']}\nAuthor:{uname} At:{r['timestamp']}\n{r['body']}\n")
+                    else:
+                        indent = "  " * r['depth']
+                        to = f" to {r['parent_id']}" if r['depth'] > 1 else ""
+                        out.append(f"\n{indent}>> Reply ID:{r['id']}{to} [{r['subject']}] by {uname} at {r['timestamp']}\n{r['body']}\n")
+                if more:
+                    out.append(f"OK MORE {offset + limit} REV {rev}\n")
+                else:
+                    out.append(f"OK REV {rev}\n")
+                return "".join(out)
+
+            elif cmd == 'SEARCH':
+                # BOARD SEARCH <testo>[|limit[|offset]]: risultati ordinati per rilevanza
+                if not self.search_enabled:
+                    return "ERR Search not available\n"
+                fields = (arg or '').split('|')
+                query = self.search_query(fields[0])
+                if not query:
+                    return "ERR SEARCH <text>[|limit[|offset]]\n"
+                try:
+                    limit = int(fields[1]) if len(fields) > 1 and fields[1].strip() else SEARCH_PAGE_SIZE
+                    offset = int(fields[2]) if len(fields) > 2 and fields[2].strip() else 0
+                except ValueError:
+                    return "ERR SEARCH <text>[|limit[|offset]]\n"
+                limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+                offset = max(0, offset)
                 c.execute("""
-                    SELECT b.id, u.username, b.timestamp, b.subject, b.body
-                    FROM board_messages b
-                    JOIN users u ON b.author_id = u.id
-                    WHERE b.parent_id=?
-                    ORDER BY b.id
-                """, (msg_id,))
-                rep = c.fetchall()
-                for rp in rep:
-                    out += f"\n  >> Reply ID:{rp['id']} [{rp['subject']}] by {rp['username']} at {rp['timestamp']}\n{rp['body']}\n"
-                return out + "OK\n"
+                    SELECT b.id, b.parent_id, b.author_id, b.timestamp, b.subject,
+                           snippet(board_fts, 1, '[', ']', '...', 12) AS snip
+                    FROM board_fts
+                    JOIN board_messages b ON b.id = board_fts.rowid
+                    WHERE board_fts MATCH ?
+                    ORDER BY bm25(board_fts, 5.0, 1.0)
+                    LIMIT ? OFFSET ?
+                """, (query, limit + 1, offset))
+                rows = c.fetchall()
+                more = len(rows) > limit
+                users = self.directory.snapshot()[0]
+                out = []
+                for r in rows[:limit]:
+                    uname = users.get(r['author_id'], ('???',))[0]
+                    kind = f" (reply to {r['parent_id']})" if r['parent_id'] is not None else ""
+                    snip = ' '.join(r['snip'].split())
+                    out.append(f"{r['id']} [{r['subject']}]{kind} by {uname} at {r['timestamp']}\n    {snip}\n")
+                if more:
+                    out.append(f"OK MORE {offset + limit}\n")
+                else:
+                    out.append("OK\n")
+                return "".join(out)
 
             elif cmd == 'NEW':
                 if '|' not in arg:
                     return "ERR Need subject|body\n"
                 subject, body = arg.split('|', 1)
                 ts = time.strftime("%Y-%m-%d %H:%M:%S")
-                c.execute("""
+                self.db.execute_write("""
                     INSERT INTO board_messages(author_id, timestamp, subject, body, parent_id)
                     VALUES (?, ?, ?, ?, NULL)
                 """, (user_id, ts, subject, body))
-                self.conn.commit()
+                self.revisions.bump('board')
                 return "OK Message posted\n"
 
             elif cmd == 'REPLY':
@@ -69,17 +246,28 @@ class BoardManager:
                     return "ERR Need pid|subj|body\n"
                 pid, subject, body = parts
                 ts = time.strftime("%Y-%m-%d %H:%M:%S")
+                # Il messaggio a cui si risponde e tutti i suoi antenati cambiano contenuto
                 c.execute("""
+                    WITH RECURSIVE up(id, parent_id) AS (
+                        SELECT id, parent_id FROM board_messages WHERE id = ?
+                        UNION ALL
+                        SELECT b.id, b.parent_id FROM board_messages b JOIN up ON b.id = up.parent_id
+                    )
+                    SELECT id FROM up
+                """, (pid,))
+                ancestors = [r['id'] for r in c.fetchall()]
+                self.db.execute_write("""
                     INSERT INTO board_messages(author_id, timestamp, subject, body, parent_id)
                     VALUES (?, ?, ?, ?, ?)
                 """, (user_id, ts, subject, body, pid))
-                self.conn.commit()
+                if ancestors:
+                    self.revisions.bump(*(('thread', a) for a in ancestors))
                 return "OK Reply posted\n"
 
             else:
                 return "ERR Unknown BOARD command\n"
 
         except Exception as e:
-            logging.error(f"BoardManager errore cmd={cmd}, user_id={user_id}: {e}")
+            log.error(f"BoardManager errore cmd={cmd}, user_id={user_id}: {e}")
             return "ERR Server error\n"
 
@@ -1,58 +1,132 @@
 import time
 import logging
+import threading
+from collections import deque
+
+log = logging.getLogger('bbs.chat')
+
+CHAT_HISTORY = 500  # messaggi conservati in memoria
 
 class ChatManager:
-    def __init__(self, conn):
-        self.conn = conn
-        self.messages = []
+    def __init__(self, db, directory, history=CHAT_HISTORY):
+        self.db = db
+        self.directory = directory
+        # Buffer circolare di (seq, riga): i messaggi più vecchi escono da soli
+        self.messages = deque(maxlen=history)
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.subscribers = {}  # conn_id -> push(bytes)
 
-    def handle_command(self, line, user_id):
+    def handle_command(self, line, user_id, ctx=None):
         parts = line.strip().split(' ', 1)
         cmd = parts[0].upper() if parts else ''
         arg = parts[1].strip() if len(parts) > 1 else ''
 
         try:
             if cmd == 'RECV':
-                out = ""
-                for m in self.messages:
-                    out += m + "\n"
-                return out + "OK\n"
+                # CHAT RECV [SINCE <seq>]: le righe successive a seq, chiuse da "OK <ultimo seq>"
+                since = 0
+                if arg:
+                    rparts = arg.split()
+                    if len(rparts) != 2 or rparts[0].upper() != 'SINCE' or not rparts[1].isdigit():
+                        return "ERR RECV [SINCE <seq>]\n"
+                    since = int(rparts[1])
+                lines, latest = self.since(since)
+                out = [m + "\n" for m in lines]
+                out.append(f"OK {latest}\n")
+                return "".join(out)
+
+            elif cmd == 'SUBSCRIBE':
+                # CHAT SUBSCRIBE [SINCE <seq>]: da qui in poi ogni nuovo messaggio viene
+                # inviato alla connessione come "MSG <seq> <riga>"
+                if ctx is None or ctx.get('push') is None:
+                    return "ERR Subscribe not supported\n"
+                since = None
+                if arg:
+                    rparts = arg.split()
+                    if len(rparts) != 2 or rparts[0].upper() != 'SINCE' or not rparts[1].isdigit():
+                        return "ERR SUBSCRIBE [SINCE <seq>]\n"
+                    since = int(rparts[1])
+                latest = self.subscribe(ctx['conn_id'], ctx['push'], since)
+                return f"OK Subscribed {latest}\n"
+
+            elif cmd == 'UNSUBSCRIBE':
+                if ctx is not None:
+                    self.unsubscribe(ctx.get('conn_id'))
+                return "OK Unsubscribed\n"
 
             elif cmd == 'SEND':
                 msg = arg.strip()
                 if not msg:
                     return "OK\n"
-                c = self.conn.cursor()
-                c.execute("SELECT username FROM users WHERE id=?", (user_id,))
-                row = c.fetchone()
-                uname = row['username'] if row else '???'
+                uname = self.directory.username(user_id)
                 timestamp = time.strftime('%H:%M:%S')
                 line_to_add = f"[{uname}] {msg} ({timestamp})"
-                self.messages.append(line_to_add)
+                self.append(line_to_add)
                 return "OK\n"
 
             elif cmd == 'SENDPRIVATE':
                 if ' ' not in arg:
                     return "ERR SENDPRIVATE <user> <msg>\n"
                 to_user, message = arg.split(' ', 1)
-                c = self.conn.cursor()
-                c.execute("SELECT id FROM users WHERE username=?", (to_user,))
-                row = c.fetchone()
-                if not row:
+                to_id = self.directory.user_id(to_user)
+                if to_id is None:
                     return "ERR user not found\n"
-                to_id = row['id']
                 ts = time.strftime('%Y-%m-%d %H:%M:%S')
-                c.execute("""
+                self.db.execute_write("""
                     INSERT INTO private_messages(from_id, to_id, timestamp, body)
                     VALUES (?, ?, ?, ?)
                 """, (user_id, to_id, ts, message))
-                self.conn.commit()
                 return "OK Private message sent\n"
 
             else:
                 return "ERR Unknown chat command\n"
 
         except Exception as e:
-            logging.error(f"Errore chat user_id={user_id}: {e}")
+            log.error(f"Errore chat user_id={user_id}: {e}")
             return "ERR Server error\n"
 
+    def append(self, line):
+        with self.lock:
+            self.seq += 1
+            self.messages.append((self.seq, line))
+            if self.subscribers:
+                # Una sola codifica condivisa da tutti gli iscritti; l'invio avviene
+                # sotto lock perché l'ordine dei seq arrivi intatto ai client
+                data = f"MSG {self.seq} {line}\n".encode('utf-8')
+                for push in self.subscribers.values():
+                    push(data)
+            return self.seq
+
+    def subscribe(self, conn_id, push, since=None):
+        """
+        Registra la connessione tra gli iscritti. Se since è indicato, i messaggi
+        successivi ancora nel buffer vengono inviati prima di quelli nuovi.
+        """
+        with self.lock:
+            if since is not None:
+                backlog = [(s, line) for s, line in reversed(self.messages) if s > since]
+                for s, line in reversed(backlog):
+                    push(f"MSG {s} {line}\n".encode('utf-8'))
+            self.subscribers[conn_id] = push
+            return self.seq
+
+    def unsubscribe(self, conn_id):
+        with self.lock:
+            self.subscribers.pop(conn_id, None)
+
+    def since(self, seq):
+        """
+        Righe con numero di sequenza maggiore di seq e ultimo seq assegnato.
+        Si scorre il buffer dalla coda, quindi il costo dipende solo dai messaggi nuovi.
+        """
+        with self.lock:
+            lines = []
+            for s, line in reversed(self.messages):
+                if s <= seq:
+                    break
+                lines.append(line)
+            latest = self.seq
+        lines.reverse()
+        return lines, latest
+
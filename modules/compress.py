@@ -0,0 +1,133 @@
+import zlib
+import asyncio
+
+COMPRESS_METHODS = ('zlib',)
+COMPRESS_LEVEL = 6
+COMPRESS_MIN = 200             # dati più corti viaggiano come blocco R, senza compressione
+BLOCK_MAX = 256 * 1024         # byte massimi (decompressi) per blocco Z
+
+class CompressStats:
+    """Byte prima e dopo la compressione, in uscita e in entrata, per tutte le connessioni."""
+    def __init__(self):
+        self.connections = 0
+        self.out_raw = 0
+        self.out_wire = 0
+        self.in_raw = 0
+        self.in_wire = 0
+
+    def gauges(self):
+        return {
+            'compress_connections': self.connections,
+            'compress_out_raw': self.out_raw,
+            'compress_out_saved': self.out_raw - self.out_wire,
+            'compress_in_saved': self.in_raw - self.in_wire,
+        }
+
+class Deflater:
+    """
+    Dopo COMPRESS zlib lo stream è fatto di blocchi "Z <n>\n" (n byte deflate,
+    chiusi da un sync flush, con un unico contesto zlib per tutta la connessione)
+    o "R <n>\n" (n byte così come sono). Il framing v1/v2 sta dentro i blocchi.
+    """
+    def __init__(self, stats, level=COMPRESS_LEVEL, threshold=COMPRESS_MIN):
+        self.z = zlib.compressobj(level)
+        self.stats = stats
+        self.threshold = threshold
+
+    def encode(self, data):
+        if len(data) < self.threshold:
+            out = b"R %d\n" % len(data) + data
+        else:
+            out = bytearray()
+            for i in range(0, len(data), BLOCK_MAX):
+                body = self.z.compress(data[i:i + BLOCK_MAX]) + self.z.flush(zlib.Z_SYNC_FLUSH)
+                out += b"Z %d\n" % len(body) + body
+            out = bytes(out)
+        self.stats.out_raw += len(data)
+        self.stats.out_wire += len(out)
+        return out
+
+    def raw_header(self, n):
+        """Intestazione di un blocco R i cui n byte vengono scritti a parte (sendfile)."""
+        header = b"R %d\n" % n
+        self.stats.out_raw += n
+        self.stats.out_wire += n + len(header)
+        return header
+
+class InflateReader:
+    """
+    Lettore al posto dello StreamReader dopo COMPRESS: decodifica i blocchi
+    in arrivo e offre readline/readexactly/read come lo StreamReader.
+    I blocchi R lunghi (byte di un upload) si leggono a pezzi, senza accumularli.
+    """
+    def __init__(self, reader, stats, limit):
+        self.reader = reader
+        self.stats = stats
+        self.limit = limit
+        self.z = zlib.decompressobj()
+        self.buf = bytearray()
+        self.scanned = 0
+        self.raw_left = 0
+
+    async def fill(self):
+        """Aggiunge al buffer i byte del prossimo blocco; False a fine stream."""
+        try:
+            if self.raw_left:
+                data = await self.reader.read(min(self.raw_left, BLOCK_MAX))
+                if not data:
+                    return False
+                self.raw_left -= len(data)
+                self.stats.in_wire += len(data)
+            else:
+                header = await self.reader.readline()
+                if not header:
+                    return False
+                kind, length = header.split()
+                length = int(length)
+                self.stats.in_wire += len(header)
+                if kind == b'R':
+                    self.raw_left = length
+                    return True
+                if kind != b'Z' or not 0 < length <= 2 * BLOCK_MAX:
+                    raise ValueError(f"blocco compresso non valido: {header[:32]!r}")
+                body = await self.reader.readexactly(length)
+                self.stats.in_wire += length
+                data = self.z.decompress(body, BLOCK_MAX)
+                if self.z.unconsumed_tail:
+                    raise ValueError(f"blocco compresso oltre {BLOCK_MAX} byte")
+        except asyncio.IncompleteReadError:
+            return False
+        except zlib.error as e:
+            raise ValueError(f"dati compressi non validi: {e}")
+        self.stats.in_raw += len(data)
+        self.buf += data
+        return True
+
+    def take(self, n):
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        self.scanned = 0
+        return data
+
+    async def readline(self):
+        while True:
+            pos = self.buf.find(b"\n", self.scanned)
+            if pos >= 0:
+                return self.take(pos + 1)
+            if len(self.buf) > self.limit:
+                raise ValueError(f"riga oltre {self.limit} byte")
+            self.scanned = len(self.buf)
+            if not await self.fill():
+                return self.take(len(self.buf))
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            if not await self.fill():
+                raise asyncio.IncompleteReadError(self.take(len(self.buf)), n)
+        return self.take(n)
+
+    async def read(self, n):
+        while not self.buf:
+            if not await self.fill():
+                return b""
+        return self.take(n)
@@ -0,0 +1,248 @@
+import sqlite3
+import threading
+import logging
+import queue
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from modules.stats import add_db_time
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursore che somma al thread corrente il tempo passato in SQLite (vedi stats)."""
+    def execute(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            add_db_time(time.perf_counter() - t0)
+
+    def executemany(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            add_db_time(time.perf_counter() - t0)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            add_db_time(time.perf_counter() - t0)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            add_db_time(time.perf_counter() - t0)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+class Database:
+    """
+    Accesso a SQLite in modalità WAL.
+    Ogni thread worker ottiene la propria connessione di sola lettura, così le
+    letture procedono in parallelo; tutte le scritture passano da un'unica
+    connessione serializzata da un lock.
+
+    Le scritture frequenti (post, risposte, messaggi privati) passano da submit():
+    un thread dedicato le raccoglie da tutte le sessioni e le esegue in un'unica
+    transazione (group commit), pagando un solo fsync per lotto.
+    """
+    def __init__(self, path, busy_timeout=5.0, batch_size=64, max_delay=0.005):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.pending = []   # azioni da eseguire dopo il commit della transazione in corso
+
+        self.write_conn = self.connect(check_same_thread=False)
+        mode = self.write_conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            logging.warning(f"Impossibile attivare WAL su {path}, journal_mode={mode}")
+
+        self.write_queue = queue.Queue()
+        self.write_thread = threading.Thread(target=self.write_loop, name='bbs-db-writer', daemon=True)
+        self.write_thread.start()
+
+    def connect(self, check_same_thread=True):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                               check_same_thread=check_same_thread, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def reader(self):
+        """Connessione di lettura del thread corrente (creata al primo uso)."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            conn.execute("PRAGMA query_only=ON")
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """
+        Transazione sulla connessione di scrittura: commit all'uscita,
+        rollback se il blocco solleva un'eccezione.
+        """
+        with self.write_lock:
+            conn = self.write_conn
+            self.pending = []
+            try:
+                yield conn
+                t0 = time.perf_counter()
+                conn.commit()
+                add_db_time(time.perf_counter() - t0)
+            except Exception:
+                conn.rollback()
+                self.pending = []
+                raise
+            self.run_after_commit()
+
+    def after_commit(self, fn):
+        """
+        Dentro un blocco writer() o una funzione passata a submit(): fn() viene
+        eseguita dopo il commit, ancora sotto il lock di scrittura, e scartata se
+        la scrittura viene annullata. Serve per le modifiche ai file sul disco.
+        """
+        self.pending.append(fn)
+
+    def run_after_commit(self):
+        pending, self.pending = self.pending, []
+        for fn in pending:
+            try:
+                fn()
+            except Exception as e:
+                logging.error(f"Errore in un'azione dopo il commit: {e}")
+
+    def backup(self, dest_path, pages=256, pause=0.02):
+        """
+        Copia online del database con l'API di backup di SQLite, pages pagine per
+        passo. La sorgente è la connessione di scrittura: le modifiche fatte nel
+        frattempo passano da lì e vengono riportate nella copia, senza farla
+        ripartire da capo. Tra un passo e l'altro il lock torna libero per pause
+        secondi, così il writer di gruppo non resta fermo per tutta la copia.
+        Restituisce il risultato di PRAGMA integrity_check sulla copia.
+        """
+        def progress(status, remaining, total):
+            self.write_lock.release()
+            try:
+                time.sleep(pause)
+            finally:
+                self.write_lock.acquire()
+
+        dst = sqlite3.connect(dest_path)
+        try:
+            with self.write_lock:
+                self.write_conn.backup(dst, pages=pages, progress=progress)
+            return dst.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            dst.close()
+
+    def submit(self, fn):
+        """
+        Accoda fn(conn) al writer di gruppo. Il Future si completa con il valore
+        restituito da fn solo dopo il commit del lotto che la contiene.
+        """
+        fut = Future()
+        self.write_queue.put((fn, fut))
+        return fut
+
+    def execute_write(self, sql, params=()):
+        """Esegue un'istruzione tramite il writer di gruppo e ne attende il commit."""
+        t0 = time.perf_counter()
+        try:
+            return self.submit(lambda conn: conn.execute(sql, params).lastrowid).result()
+        finally:
+            # Per chi scrive, l'attesa del commit di gruppo è tempo speso nel database
+            add_db_time(time.perf_counter() - t0)
+
+    def write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                try:
+                    timeout = deadline - time.monotonic()
+                    nxt = self.write_queue.get(timeout=timeout) if timeout > 0 else self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self.commit_batch(batch)
+            if stop:
+                return
+
+    def commit_batch(self, batch):
+        results = []
+        with self.write_lock:
+            conn = self.write_conn
+            self.pending = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, fut in batch:
+                    # Un savepoint per voce: un'istruzione fallita non annulla il resto del lotto
+                    conn.execute("SAVEPOINT item")
+                    mark = len(self.pending)
+                    try:
+                        value = fn(conn)
+                        conn.execute("RELEASE item")
+                        results.append((fut, value, None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO item")
+                        conn.execute("RELEASE item")
+                        del self.pending[mark:]
+                        results.append((fut, None, e))
+                conn.commit()
+            except Exception as e:
+                logging.error(f"Errore commit di gruppo ({len(batch)} scritture): {e}")
+                self.pending = []
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+                for fn, fut in batch:
+                    fut.set_exception(e)
+                return
+            self.run_after_commit()
+        for fut, value, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(value)
+
+    def close(self):
+        self.write_queue.put(None)
+        self.write_thread.join()
+        with self.readers_lock:
+            readers, self.readers = self.readers, []
+        for conn in readers:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # Connessione creata da un altro thread: verrà chiusa alla sua terminazione
+                pass
+        with self.write_lock:
+            self.write_conn.close()
@@ -1,61 +1,302 @@
 import os
+import re
 import time
+import hashlib
 import logging
+import threading
+from modules.blobstore import BlobStore, HASH_CHUNK
+from modules.revisions import Revisions, split_ifnewer
+
+UPLOAD_DIR = '/opt/mybbs/data/uploads'
+MAX_UPLOAD_BYTES = 1024 * 1024 * 1024
+VISIBILITIES = ('public', 'private')
+SHA_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def discard(path):
+    """Rimuove un file sorgente già archiviato (può essere già sparito)."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class Upload:
+    """
+    Trasferimento FILE PUT: il server invia header e poi legge dal socket
+    i byte mancanti, accodandoli al file parziale e calcolandone lo sha256.
+    """
+    def __init__(self, manager, user_id, partial, filename, desc, vis, size, offset, sha=None):
+        self.manager = manager
+        self.user_id = user_id
+        self.partial = partial
+        self.filename = filename
+        self.desc = desc
+        self.vis = vis
+        self.size = size
+        self.offset = offset
+        self.sha = sha                  # dichiarato dal client, se presente
+        self.remaining = size - offset
+        self.header = f"OK READY {offset}\n"
+        self.hasher = None
+        self.f = None
+
+    def open(self):
+        self.hasher = hashlib.sha256()
+        if self.offset:
+            # Ripresa: l'hash riparte dai byte ricevuti nei tentativi precedenti
+            with open(self.partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                    self.hasher.update(chunk)
+        self.f = open(self.partial, 'ab')
+
+    def write(self, chunk):
+        self.f.write(chunk)
+        self.hasher.update(chunk)
+
+    def close(self):
+        self.f.close()
+
+    def finish(self):
+        return self.manager.finish_upload(self)
+
+    def release(self):
+        """A trasferimento concluso o interrotto: il parziale torna disponibile."""
+        self.manager.release_partial(self.partial)
+
+class Download:
+    """Trasferimento FILE GET: header seguito da count byte del file a partire da offset."""
+    def __init__(self, path, total, offset):
+        self.path = path
+        self.total = total
+        self.offset = offset
+        self.count = total - offset
+        self.header = f"OK DATA {total} {offset} {self.count}\n"
 
 class FilesManager:
-    def __init__(self, conn):
-        self.conn = conn
-        self.upload_dir = '/opt/mybbs/data/uploads'
+    def __init__(self, db, directory, revisions=None, upload_dir=UPLOAD_DIR):
+        self.db = db
+        self.directory = directory
+        self.revisions = revisions if revisions is not None else Revisions()
+        self.upload_dir = upload_dir
+        # Upload interrotti, ripresi dal byte già ricevuto
+        self.partial_dir = os.path.join(self.upload_dir, '.partial')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        # Parziali con un trasferimento in corso: un secondo PUT accoderebbe allo stesso file
+        self.active_partials = set()
+        self.partials_lock = threading.Lock()
+        self.store = BlobStore(os.path.join(self.upload_dir, 'blobs'))
+        self.ensure_schema()
+        self.migrate_legacy()
+        with self.db.writer() as conn:
+            removed = self.collect_garbage(conn)
+        if removed:
+            logging.info(f"Archivio file: rimossi {removed} contenuti non più referenziati.")
+
+    def ensure_schema(self):
+        """
+        Tabella blobs (un contenuto per sha256, con il numero di file che lo usano)
+        e colonne blob_sha/size in files; i trigger tengono aggiornato refcount.
+        """
+        with self.db.writer() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs(sha) WHERE refcount = 0")
+            columns = {r['name'] for r in conn.execute("PRAGMA table_info(files)")}
+            if 'blob_sha' not in columns:
+                conn.execute("ALTER TABLE files ADD COLUMN blob_sha TEXT REFERENCES blobs(sha)")
+            if 'size' not in columns:
+                conn.execute("ALTER TABLE files ADD COLUMN size INTEGER")
+            # Per FILE PUT senza trasferimento: l'utente ha già un file con questo contenuto?
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_blob ON files(blob_sha, uploader_id)")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS files_blob_ai AFTER INSERT ON files
+                WHEN new.blob_sha IS NOT NULL BEGIN
+                    UPDATE blobs SET refcount = refcount + 1 WHERE sha = new.blob_sha;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS files_blob_ad AFTER DELETE ON files
+                WHEN old.blob_sha IS NOT NULL BEGIN
+                    UPDATE blobs SET refcount = refcount - 1 WHERE sha = old.blob_sha;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS files_blob_au AFTER UPDATE OF blob_sha ON files BEGIN
+                    UPDATE blobs SET refcount = refcount - 1 WHERE sha = old.blob_sha;
+                    UPDATE blobs SET refcount = refcount + 1 WHERE sha = new.blob_sha;
+                END
+            """)
+
+    def migrate_legacy(self):
+        """Sposta nell'archivio per hash i file registrati prima dei blob (salvati per nome)."""
+        c = self.db.reader().cursor()
+        c.execute("SELECT DISTINCT filename FROM files WHERE blob_sha IS NULL")
+        for row in c.fetchall():
+            path = os.path.join(self.upload_dir, os.path.basename(row['filename']))
+            if not os.path.isfile(path):
+                logging.warning(f"Migrazione archivio file: {row['filename']} non trovato in uploads/")
+                continue
+            sha, size = self.store.hash_file(path)
+            with self.db.writer() as conn:
+                conn.execute("INSERT OR IGNORE INTO blobs(sha, size) VALUES (?, ?)", (sha, size))
+                conn.execute("UPDATE files SET blob_sha=?, size=? WHERE filename=? AND blob_sha IS NULL",
+                             (sha, size, row['filename']))
+                self.store.link(path, sha)
+                self.db.after_commit(lambda path=path: discard(path))
+            logging.info(f"Migrazione archivio file: {row['filename']} -> {sha}")
 
     def handle_command(self, line, user_id):
         parts = line.strip().split(' ', 1)
         cmd = parts[0].upper() if parts else ''
         arg = parts[1].strip() if len(parts) > 1 else ''
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         try:
             if cmd == 'LIST':
+                # FILE LIST [IFNEWER <rev>]
+                try:
+                    since, _ = split_ifnewer(arg)
+                except ValueError:
+                    return "ERR LIST [IFNEWER <rev>]\n"
+                rev = self.revisions.get('files')
+                if since is not None and rev <= since:
+                    return "OK NOTMODIFIED\n"
                 c.execute("""
-                    SELECT f.id, u.username, f.filename, f.visibility
-                    FROM files f
-                    JOIN users u ON f.uploader_id = u.id
-                    ORDER BY f.id
+                    SELECT id, uploader_id, filename, visibility
+                    FROM files
+                    ORDER BY id
                 """)
                 rows = c.fetchall()
-                out = ""
+                users = self.directory.snapshot()[0]
+                out = []
                 for r in rows:
-                    out += f"{r['id']} {r['filename']} by {r['username']} [{r['visibility']}]\n"
-                return out + "OK\n"
+                    uname = users.get(r['uploader_id'], ('???',))[0]
+                    out.append(f"{r['id']} {r['filename']} by {uname} [{r['visibility']}]\n")
+                out.append(f"OK REV {rev}\n")
+                return "".join(out)
 
             elif cmd == 'INFO':
                 if not arg:
                     return "ERR INFO <id>\n"
                 fid = arg.strip()
                 c.execute("""
-                    SELECT f.id, u.username, f.filename, f.description, f.visibility
-                    FROM files f
-                    JOIN users u ON f.uploader_id = u.id
-                    WHERE f.id=?
+                    SELECT id, uploader_id, filename, description, visibility, blob_sha, size
+                    FROM files
+                    WHERE id=?
                 """, (fid,))
                 row = c.fetchone()
-                if not row:
+                if not row or (row['visibility'] == 'private' and row['uploader_id'] != user_id):
                     return "ERR Not found\n"
+                uname = self.directory.username(row['uploader_id'])
                 out = (f"ID:{row['id']} File:{row['filename']}\n"
-                       f"Uploader:{row['username']}\nVisibility:{row['visibility']}\nDescription:{row['description']}\n")
+                       f"Uploader:{uname}\nVisibility:{row['visibility']}\nDescription:{row['description']}\n")
+                if row['blob_sha']:
+                    out += f"Size:{row['size']}\nSHA256:{row['blob_sha']}\n"
                 return out + "OK\n"
 
             elif cmd == 'REGISTER':
                 if '|' not in arg:
                     return "ERR REGISTER filename|desc|vis\n"
                 filename, desc, vis = arg.split('|', 2)
+                filename = os.path.basename(filename.strip())
+                if not filename or filename.startswith('.'):
+                    return "ERR Invalid filename\n"
                 path = os.path.join(self.upload_dir, filename)
-                if not os.path.exists(path):
+                if not os.path.isfile(path):
                     return "ERR file not uploaded\n"
-                c.execute("""
-                    INSERT INTO files(uploader_id, filename, description, visibility)
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, filename, desc, vis))
-                self.conn.commit()
-                return "OK File registered\n"
+                # Il file caricato fuori banda entra nell'archivio per hash
+                sha, size = self.store.hash_file(path)
+                fid = self.db.submit(
+                    lambda conn: self.store_and_register(conn, path, sha, size, user_id, filename, desc, vis)
+                ).result()
+                self.revisions.bump('files')
+                return f"OK File registered {fid}\n"
+
+            elif cmd == 'PUT':
+                # FILE PUT <size>|<filename>|<desc>|<vis>[|<sha256>], poi <size - offset> byte grezzi
+                fields = arg.split('|', 4)
+                if len(fields) < 4:
+                    return "ERR PUT size|filename|desc|vis[|sha256]\n"
+                try:
+                    size = int(fields[0])
+                except ValueError:
+                    return "ERR PUT size|filename|desc|vis[|sha256]\n"
+                filename = os.path.basename(fields[1].strip())
+                desc, vis = fields[2], fields[3].strip()
+                sha = fields[4].strip().lower() if len(fields) > 4 else None
+                if not filename or filename.startswith('.'):
+                    return "ERR Invalid filename\n"
+                if vis not in VISIBILITIES:
+                    return "ERR Visibility must be public or private\n"
+                if size < 0 or size > MAX_UPLOAD_BYTES:
+                    return f"ERR Size must be between 0 and {MAX_UPLOAD_BYTES}\n"
+                if sha is not None and not SHA_RE.match(sha):
+                    return "ERR Invalid sha256\n"
+                if sha is not None:
+                    # Contenuto che l'utente ha già caricato: basta una riga in files, nessun
+                    # trasferimento. Lo sha da solo non prova di avere il contenuto, quindi per
+                    # i blob di altri utenti si trasferisce comunque (sul disco resta una copia)
+                    fid = self.db.submit(
+                        lambda conn: self.register_existing(conn, sha, size, user_id, filename, desc, vis)
+                    ).result()
+                    if fid is not None:
+                        self.revisions.bump('files')
+                        logging.info(f"Upload {filename} di user_id={user_id}: contenuto già presente ({sha})")
+                        return f"OK File registered {fid}\n"
+                # Stesso utente, nome e dimensione: si riprende il parziale esistente
+                partial = os.path.join(self.partial_dir, f"{user_id}-{size}-{filename}")
+                with self.partials_lock:
+                    if partial in self.active_partials:
+                        return "ERR Upload already in progress\n"
+                    self.active_partials.add(partial)
+                try:
+                    offset = min(os.path.getsize(partial), size) if os.path.exists(partial) else 0
+                except OSError:
+                    self.release_partial(partial)
+                    raise
+                if offset:
+                    logging.info(f"Upload {filename} di user_id={user_id} ripreso da {offset}/{size}")
+                return Upload(self, user_id, partial, filename, desc, vis, size, offset, sha)
+
+            elif cmd == 'GET':
+                # FILE GET <id> [offset]
+                args = arg.split()
+                if not args:
+                    return "ERR GET <id> [offset]\n"
+                try:
+                    offset = int(args[1]) if len(args) > 1 else 0
+                except ValueError:
+                    return "ERR GET <id> [offset]\n"
+                c.execute("SELECT uploader_id, filename, visibility, blob_sha FROM files WHERE id=?", (args[0],))
+                row = c.fetchone()
+                if not row or (row['visibility'] == 'private' and row['uploader_id'] != user_id):
+                    return "ERR Not found\n"
+                if row['blob_sha']:
+                    path = self.store.path(row['blob_sha'])
+                else:
+                    path = os.path.join(self.upload_dir, row['filename'])
+                try:
+                    total = os.path.getsize(path)
+                except OSError:
+                    return "ERR File missing\n"
+                return Download(path, total, max(0, min(offset, total)))
+
+            elif cmd == 'DELETE':
+                # FILE DELETE <id>: chi l'ha caricato o un admin
+                if not arg:
+                    return "ERR DELETE <id>\n"
+                c.execute("SELECT uploader_id FROM files WHERE id=?", (arg,))
+                row = c.fetchone()
+                if not row:
+                    return "ERR Not found\n"
+                if row['uploader_id'] != user_id and self.directory.role(user_id) != 'admin':
+                    return "ERR Not allowed\n"
+                self.db.submit(lambda conn: self.delete_file(conn, arg)).result()
+                self.revisions.bump('files')
+                return "OK File deleted\n"
 
             else:
                 return "ERR Unknown file command\n"
@@ -64,3 +305,83 @@ class FilesManager:
             logging.error(f"Errore FilesManager user_id={user_id}: {e}")
             return "ERR Server error\n"
 
+    # Le funzioni seguenti girano nel writer di gruppo: le modifiche all'archivio
+    # dei blob sono serializzate con quelle del database e la raccolta dei blob
+    # inutilizzati non può incrociarsi con un nuovo riferimento allo stesso contenuto.
+    # Sul disco si crea prima del commit (un collegamento) e si cancella solo dopo,
+    # così una scrittura annullata non perde né il caricamento né un blob in uso.
+
+    def store_and_register(self, conn, src, sha, size, user_id, filename, desc, vis):
+        conn.execute("INSERT OR IGNORE INTO blobs(sha, size) VALUES (?, ?)", (sha, size))
+        self.store.link(src, sha)
+        fid = conn.execute("""
+            INSERT INTO files(uploader_id, filename, description, visibility, blob_sha, size)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, filename, desc, vis, sha, size)).lastrowid
+        self.db.after_commit(lambda: discard(src))
+        return fid
+
+    def register_existing(self, conn, sha, size, user_id, filename, desc, vis):
+        if not conn.execute("SELECT 1 FROM files WHERE uploader_id=? AND blob_sha=? AND size=? LIMIT 1",
+                            (user_id, sha, size)).fetchone():
+            return None
+        return conn.execute("""
+            INSERT INTO files(uploader_id, filename, description, visibility, blob_sha, size)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, filename, desc, vis, sha, size)).lastrowid
+
+    def delete_file(self, conn, fid):
+        row = conn.execute("SELECT blob_sha FROM files WHERE id=?", (fid,)).fetchone()
+        conn.execute("DELETE FROM files WHERE id=?", (fid,))
+        if row and row['blob_sha']:
+            self.collect_garbage(conn, row['blob_sha'])
+
+    def collect_garbage(self, conn, sha=None):
+        """
+        Elimina i blob con refcount a zero (solo sha, se indicato); i file spariscono
+        dopo il commit. Senza sha elimina anche i file dell'archivio senza riga in
+        blobs, lasciati da scritture annullate. Restituisce quanti.
+        """
+        if sha is None:
+            rows = conn.execute("SELECT sha FROM blobs WHERE refcount = 0").fetchall()
+        else:
+            rows = conn.execute("SELECT sha FROM blobs WHERE refcount = 0 AND sha=?", (sha,)).fetchall()
+        unused = [r['sha'] for r in rows]
+        for s in unused:
+            conn.execute("DELETE FROM blobs WHERE sha=?", (s,))
+        if sha is None:
+            known = {r['sha'] for r in conn.execute("SELECT sha FROM blobs")}
+            unused += [s for s in self.store.shas() if s not in known and s not in unused]
+        for s in unused:
+            self.db.after_commit(lambda s=s: self.remove_blob(s))
+        return len(unused)
+
+    def remove_blob(self, sha):
+        # Dopo il commit: una voce successiva dello stesso lotto può aver registrato di nuovo il contenuto
+        if self.db.write_conn.execute("SELECT 1 FROM blobs WHERE sha=?", (sha,)).fetchone() is None:
+            self.store.remove(sha)
+
+    def release_partial(self, partial):
+        with self.partials_lock:
+            self.active_partials.discard(partial)
+
+    def finish_upload(self, upload):
+        """Chiamata a trasferimento completato: salva il contenuto per hash e lo registra."""
+        try:
+            if os.path.getsize(upload.partial) != upload.size:
+                os.remove(upload.partial)
+                return "ERR Size mismatch, upload discarded\n"
+            sha = upload.hasher.hexdigest()
+            if upload.sha and upload.sha != sha:
+                os.remove(upload.partial)
+                return "ERR Checksum mismatch, upload discarded\n"
+            fid = self.db.submit(
+                lambda conn: self.store_and_register(conn, upload.partial, sha, upload.size, upload.user_id,
+                                                     upload.filename, upload.desc, upload.vis)
+            ).result()
+            self.revisions.bump('files')
+            logging.info(f"Upload completato: {upload.filename} ({upload.size} byte, {sha}) id={fid}")
+            return f"OK File registered {fid}\n"
+        except Exception as e:
+            logging.error(f"Errore upload {upload.filename} user_id={upload.user_id}: {e}")
+            return "ERR Server error\n"
@@ -0,0 +1,156 @@
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+QUEUE_SIZE = 10000       # record in attesa oltre i quali si scarta invece di bloccare
+BATCH_SIZE = 256         # record scritti per ogni flush su disco
+
+# Sottosistemi con livello configurabile separatamente (logger "bbs.<nome>")
+SUBSYSTEMS = ('net', 'auth', 'board', 'chat')
+CMD_LOGGER = 'bbs.net.cmd'
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler che non blocca mai il thread chiamante: a coda piena il
+    record viene scartato e contato.
+    """
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # I messaggi sono già f-string: la formattazione si lascia al writer
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler che fa il flush solo a fine lotto, su richiesta del writer.
+    La dimensione del file la tiene un contatore: il controllo della rotazione
+    di RotatingFileHandler fa un seek (che svuota il buffer) e riformatta il
+    record a ogni scrittura.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.size = self.stream.tell() if self.stream else 0
+        self.next_len = 0
+
+    def shouldRollover(self, record):
+        return self.maxBytes > 0 and self.size > 0 and self.size + self.next_len > self.maxBytes
+
+    def doRollover(self):
+        super().doRollover()
+        self.size = self.stream.tell() if self.stream else 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            self.next_len = len(msg.encode(self.encoding or 'utf-8', errors='replace'))
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+                self.size = self.stream.tell()
+            self.stream.write(msg)
+            self.size += self.next_len
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+class SampleFilter(logging.Filter):
+    """Lascia passare un record ogni rate (rate=1: tutti, rate=0: nessuno)."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return False
+        return next(self.counter) % self.rate == 0
+
+class LogWriter(threading.Thread):
+    """Svuota la coda dei record e li scrive a lotti sul file, con rotazione per dimensione."""
+    def __init__(self, q, handler):
+        super().__init__(name='bbs-log-writer', daemon=True)
+        self.queue = q
+        self.handler = handler
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    self.handler.flush_batch()
+                    return
+                self.handler.handle(record)
+            self.handler.flush_batch()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(timeout=5)
+        self.handler.close()
+
+def parse_levels(spec):
+    """'net=DEBUG,auth=INFO' -> {'net': 10, 'auth': 20}."""
+    levels = {}
+    for item in filter(None, (s.strip() for s in (spec or '').split(','))):
+        name, _, level = item.partition('=')
+        name = name.strip().lower()
+        if name not in SUBSYSTEMS:
+            raise ValueError(f"sottosistema sconosciuto '{name}' (validi: {', '.join(SUBSYSTEMS)})")
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError(f"livello non valido '{level}' per {name}")
+        levels[name] = value
+    return levels
+
+def setup_logging(log_file, level=logging.INFO, levels=None, sample=1,
+                  max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """
+    I thread che gestiscono le richieste si limitano ad accodare i record; un
+    thread dedicato li scrive sul file a lotti. Restituisce il QueueHandler
+    (il suo contatore dropped indica i record scartati a coda piena).
+    """
+    handler = BatchRotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    q = queue.Queue(QUEUE_SIZE)
+    qh = DroppingQueueHandler(q)
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(qh)
+    root.setLevel(level)
+    for name, lvl in (levels or {}).items():
+        logging.getLogger(f'bbs.{name}').setLevel(lvl)
+    logging.getLogger(CMD_LOGGER).addFilter(SampleFilter(sample))
+
+    writer = LogWriter(q, handler)
+    writer.start()
+    atexit.register(writer.stop)
+    return qh
@@ -0,0 +1,202 @@
+import math
+import time
+from modules.stats import command_key
+from modules.revisions import split_ifnewer
+from modules.board import LIST_PAGE_SIZE, READ_PAGE_SIZE
+from modules.users import PMSG_PAGE_SIZE
+from modules.textlib import PAGE_BYTES, split_range
+
+# Classi di comandi: quelli non elencati sono 'read'. RESUME non fa bcrypt e resta
+# 'read', così una raffica di riconnessioni non occupa i posti dei comandi costosi.
+COMMAND_CLASSES = {
+    'LOGIN': 'auth',
+    'PASSWD': 'auth',
+    'BOARD NEW': 'write',
+    'BOARD REPLY': 'write',
+    'CHAT SEND': 'write',
+    'CHAT SENDPRIVATE': 'write',
+    'PMSG WRITE': 'write',
+    'PMSG READALL': 'write',
+    'PMSG DELETE': 'write',
+    'FILE REGISTER': 'write',
+    'FILE PUT': 'write',
+    'FILE DELETE': 'write',
+    'BOARD SEARCH': 'heavy',
+    'TEXT SEARCH': 'heavy',
+    'ADMIN BACKUP': 'heavy',
+    'ADMIN ADDUSER': 'heavy',
+    'ADMIN ADDUSER-NONADMIN': 'heavy',
+}
+# Letture che diventano 'heavy' se chiedono più di una pagina normale:
+# comando -> (posizione del limite tra gli argomenti, pagina normale)
+LARGE_READS = {
+    'BOARD LIST': (1, LIST_PAGE_SIZE),
+    'BOARD READ': (2, READ_PAGE_SIZE),
+    'PMSG LIST': (1, PMSG_PAGE_SIZE),
+    'TEXT READ': (None, PAGE_BYTES),
+}
+CLASSES = ('auth', 'write', 'heavy', 'read')
+# Classi che occupano un posto del limite globale di concorrenza (bcrypt, ricerche, backup)
+CONCURRENT_CLASSES = ('auth', 'heavy')
+
+# Token al secondo / capienza del secchio; 0 al secondo = nessun limite per la classe
+SESSION_RATES = {'auth': (0.5, 5), 'write': (5, 20), 'heavy': (1, 5), 'read': (50, 200)}
+USER_RATES = {'auth': (1, 10), 'write': (10, 40), 'heavy': (2, 10), 'read': (100, 400)}
+MAX_HEAVY = 4                  # comandi 'auth'/'heavy' in esecuzione contemporaneamente
+PRUNE_EVERY = 4096             # ogni quante decisioni si scartano i secchi già pieni
+
+def command_class(line):
+    key = command_key(line)
+    cls = COMMAND_CLASSES.get(key)
+    if cls is not None:
+        return cls
+    if key in LARGE_READS and large_read(key, line):
+        return 'heavy'
+    return 'read'
+
+def large_read(key, line):
+    """True se la lettura indica esplicitamente un limite oltre la pagina normale."""
+    pos, normal = LARGE_READS[key]
+    parts = line.split(' ', 2)
+    try:
+        _, arg = split_ifnewer(parts[2] if len(parts) > 2 else '')
+        if pos is None:
+            # TEXT READ <nome> [offset] [lunghezza]
+            _, numbers = split_range(arg)
+            return len(numbers) > 1 and numbers[1] > normal
+        args = arg.split()
+        if key == 'PMSG LIST' and args and args[0].upper() == 'ALL':
+            args = args[1:]
+        return len(args) > pos and int(args[pos]) > normal
+    except ValueError:
+        return False
+
+def parse_rates(spec):
+    """'write=5/20,auth=0.5/5' -> {'write': (5.0, 20.0), 'auth': (0.5, 5.0)}."""
+    rates = {}
+    for item in filter(None, (s.strip() for s in (spec or '').split(','))):
+        name, _, value = item.partition('=')
+        name = name.strip().lower()
+        if name not in CLASSES:
+            raise ValueError(f"classe sconosciuta '{name}' (valide: {', '.join(CLASSES)})")
+        rate, _, burst = value.partition('/')
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1.0)
+        except ValueError:
+            raise ValueError(f"limite non valido '{value}' per {name} (formato: token_al_secondo/capienza)")
+        if rate < 0 or burst < 1:
+            raise ValueError(f"limite non valido '{value}' per {name}")
+        rates[name] = (rate, burst)
+    return rates
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait(self, now):
+        """Secondi da attendere per avere un token (0 se c'è già); ricarica il secchio."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+class RateLimiter:
+    """
+    Controllo di ammissione dei comandi: un secchio di token per connessione e
+    uno per utente per ogni classe di comandi, più un tetto globale ai comandi
+    costosi in esecuzione. Un comando fuori limite non consuma token e riceve
+    subito ERR BUSY retry-after=N invece di accodarsi.
+
+    Viene usato solo dall'event loop, quindi non servono lock.
+    """
+    def __init__(self, session_rates=None, user_rates=None, max_heavy=MAX_HEAVY):
+        self.session_rates = dict(SESSION_RATES, **(session_rates or {}))
+        self.user_rates = dict(USER_RATES, **(user_rates or {}))
+        self.max_heavy = max_heavy
+        self.conn_buckets = {}    # conn_id -> {classe: TokenBucket}
+        self.user_buckets = {}    # user_id -> {classe: TokenBucket}
+        self.running = 0
+        self.decisions = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(CLASSES, 0)
+        self.busy = 0             # rifiutati per il tetto di concorrenza
+
+    def bucket(self, table, owner, rates, cls, now):
+        rate, burst = rates[cls]
+        if not rate:
+            return None
+        buckets = table.setdefault(owner, {})
+        b = buckets.get(cls)
+        if b is None:
+            b = buckets[cls] = TokenBucket(rate, burst, now)
+        return b
+
+    def admit(self, ctx, line):
+        """
+        Restituisce (classe, attesa): attesa 0 se il comando può partire, altrimenti
+        i secondi (interi, almeno 1) da indicare nel retry-after. Se il comando è
+        ammesso e la classe è concorrente va chiamato release(classe) al termine.
+        """
+        cls = command_class(line)
+        now = time.monotonic()
+        self.decisions += 1
+        if self.decisions % PRUNE_EVERY == 0:
+            self.prune(now)
+
+        if cls in CONCURRENT_CLASSES and self.max_heavy and self.running >= self.max_heavy:
+            self.busy += 1
+            return cls, 1
+
+        buckets = [self.bucket(self.conn_buckets, ctx['conn_id'], self.session_rates, cls, now)]
+        if ctx['user_id'] is not None:
+            buckets.append(self.bucket(self.user_buckets, ctx['user_id'], self.user_rates, cls, now))
+        buckets = [b for b in buckets if b is not None]
+        wait = max([b.wait(now) for b in buckets], default=0.0)
+        if wait:
+            self.shed[cls] += 1
+            return cls, max(1, math.ceil(wait))
+
+        for b in buckets:
+            b.tokens -= 1
+        if cls in CONCURRENT_CLASSES:
+            self.running += 1
+        self.admitted += 1
+        return cls, 0
+
+    def release(self, cls):
+        if cls in CONCURRENT_CLASSES:
+            self.running -= 1
+
+    def occupy(self, cls):
+        """
+        Per il socket admin (backup notturni, adduser): il comando non viene mai
+        rifiutato, ma finché è in esecuzione occupa un posto del tetto e i client
+        trovano meno spazio per altro lavoro costoso. Va chiamato release(classe).
+        """
+        if cls in CONCURRENT_CLASSES:
+            self.running += 1
+
+    def forget(self, conn_id):
+        """Alla chiusura della connessione."""
+        self.conn_buckets.pop(conn_id, None)
+
+    def prune(self, now):
+        # Un secchio pieno equivale a uno nuovo: gli utenti fermi non occupano memoria
+        for user_id in [u for u, buckets in self.user_buckets.items()
+                        if all(b.full(now) for b in buckets.values())]:
+            del self.user_buckets[user_id]
+
+    def gauges(self):
+        gauges = {'ratelimit_admitted': self.admitted, 'ratelimit_busy': self.busy,
+                  'ratelimit_running': self.running}
+        for cls, n in self.shed.items():
+            gauges[f'ratelimit_shed_{cls}'] = n
+        return gauges
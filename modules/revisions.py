@@ -0,0 +1,40 @@
+import time
+import itertools
+import threading
+
+class Revisions:
+    """
+    Numeri di revisione in memoria per le risorse che i client rileggono spesso:
+    'board' (elenco dei thread), ('thread', id), 'files' (catalogo), 'docs'
+    (elenco dei documenti) e ('doc', nome).
+
+    Le revisioni partono dall'ora di avvio in microsecondi: una risorsa mai
+    modificata da allora vale base, ogni modifica prende un numero più alto, e
+    una revisione ricevuta prima di un riavvio risulta sempre più vecchia.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.base = time.time_ns() // 1000
+        self.counter = itertools.count(self.base + 1)
+        self.revs = {}
+
+    def get(self, key):
+        return self.revs.get(key, self.base)
+
+    def bump(self, *keys):
+        """Da chiamare dopo che la modifica è stata scritta."""
+        with self.lock:
+            rev = next(self.counter)
+            for key in keys:
+                self.revs[key] = rev
+        return rev
+
+def split_ifnewer(arg):
+    """
+    'IFNEWER 42 10 5' -> (42, '10 5'); senza IFNEWER -> (None, arg).
+    ValueError se la revisione non è un numero.
+    """
+    parts = (arg or '').split(None, 2)
+    if len(parts) < 2 or parts[0].upper() != 'IFNEWER':
+        return None, arg
+    return int(parts[1]), parts[2] if len(parts) > 2 else ''
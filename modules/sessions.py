@@ -0,0 +1,115 @@
+import itertools
+import threading
+
+MAX_SESSIONS = 2000            # sessioni autenticate in tutto il server
+MAX_SESSIONS_PER_USER = 5      # sessioni contemporanee dello stesso utente
+
+class SessionLimit(Exception):
+    """Login rifiutato perché si supererebbe un limite di sessioni."""
+
+class Session:
+    __slots__ = ('session_id', 'user_id', 'username', 'addr', 'conn_id', 'token')
+
+    def __init__(self, session_id, user_id, username, addr, conn_id=None, token=None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.username = username
+        self.addr = addr
+        self.conn_id = conn_id
+        self.token = token
+
+class SessionRegistry:
+    """
+    Sessioni autenticate, accessibili da tutti i worker: gli id vengono da un
+    contatore (next() è atomico), le modifiche avvengono sotto lock e la
+    risposta di WHO resta pronta finché l'insieme delle sessioni non cambia.
+    """
+    def __init__(self, max_sessions=MAX_SESSIONS, max_per_user=MAX_SESSIONS_PER_USER):
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.sessions = {}      # session_id -> Session
+        self.per_user = {}      # user_id -> numero di sessioni aperte
+        self.tokens = {}        # token di ripresa -> session_id
+        self.who_cache = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def full(self):
+        """Controllo rapido prima di verificare la password."""
+        return len(self.sessions) >= self.max_sessions
+
+    def open(self, addr, user_id, username, conn_id=None, token=None):
+        """
+        Registra una sessione; restituisce (session_id, sessione sostituita o None).
+        Con un token ancora legato a una sessione aperta (RESUME dopo una caduta
+        della linea) la nuova sessione prende il posto di quella vecchia, che non
+        conta più nei limiti. SessionLimit se non c'è posto.
+        """
+        with self.lock:
+            replaced = self.sessions.get(self.tokens.get(token)) if token else None
+            if replaced is not None:
+                self.remove(replaced)
+            if len(self.sessions) >= self.max_sessions:
+                raise SessionLimit(f"Too many sessions ({self.max_sessions})")
+            count = self.per_user.get(user_id, 0)
+            if count >= self.max_per_user:
+                raise SessionLimit(f"Too many sessions for {username} ({self.max_per_user})")
+            session_id = next(self.ids)
+            self.sessions[session_id] = Session(session_id, user_id, username, addr, conn_id, token)
+            self.per_user[user_id] = count + 1
+            if token:
+                self.tokens[token] = session_id
+            self.who_cache = None
+        return session_id, replaced
+
+    def bind_token(self, session_id, token):
+        """Dopo LOGIN: il token emesso potrà riprendere questa sessione."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and token:
+                session.token = token
+                self.tokens[token] = session_id
+
+    def close(self, session_id):
+        """Rimuove la sessione; restituisce False se non c'era."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            self.remove(session)
+        return True
+
+    def remove(self, session):
+        # Da chiamare con il lock
+        del self.sessions[session.session_id]
+        count = self.per_user[session.user_id] - 1
+        if count:
+            self.per_user[session.user_id] = count
+        else:
+            del self.per_user[session.user_id]
+        if session.token and self.tokens.get(session.token) == session.session_id:
+            del self.tokens[session.token]
+        self.who_cache = None
+
+    def who(self):
+        """Risposta di WHO: un utente per riga, con il numero di sessioni se più di una."""
+        out = self.who_cache
+        if out is not None:
+            return out
+        with self.lock:
+            names = {}
+            for s in self.sessions.values():
+                names[s.username] = names.get(s.username, 0) + 1
+            if not names:
+                out = "Nessun utente connesso.\nOK\n"
+            else:
+                lines = [f"- {n} ({c} sessioni)\n" if c > 1 else f"- {n}\n" for n, c in sorted(names.items())]
+                out = "Utenti attualmente connessi:\n" + "".join(lines) + "OK\n"
+            self.who_cache = out
+        return out
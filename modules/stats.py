@@ -0,0 +1,125 @@
+import time
+import json
+import bisect
+import threading
+
+# Limiti superiori (s) dei bucket dell'istogramma delle latenze: da 0.1 ms a ~52 s
+LATENCY_BOUNDS = [0.0001 * 2 ** i for i in range(20)]
+MAX_KEYS = 256                 # comandi distinti tracciati; gli altri finiscono in OTHER
+SUBCOMMANDS = ('BOARD', 'FILE', 'TEXT', 'CHAT', 'ADMIN', 'PMSG')
+
+_local = threading.local()
+
+def add_db_time(seconds):
+    """Accumula tempo passato in SQLite dal thread corrente."""
+    _local.db_time = getattr(_local, 'db_time', 0.0) + seconds
+
+def take_db_time():
+    """Tempo SQLite accumulato dal thread corrente dall'ultima chiamata."""
+    t = getattr(_local, 'db_time', 0.0)
+    _local.db_time = 0.0
+    return t
+
+def command_key(line):
+    """'board list 10' -> 'BOARD LIST'; i comandi senza sottocomandi restano da soli."""
+    parts = line.split(' ', 2)
+    cmd = parts[0].upper()
+    if cmd in SUBCOMMANDS and len(parts) > 1:
+        return f"{cmd} {parts[1].upper()}"
+    return cmd
+
+class CommandStats:
+    __slots__ = ('count', 'errors', 'total', 'max', 'db_time', 'bytes_in', 'bytes_out', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.db_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+
+    def percentile(self, q):
+        """Limite superiore del bucket che contiene il q-esimo quantile (al più il massimo osservato)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(LATENCY_BOUNDS[i], self.max) if i < len(LATENCY_BOUNDS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'p50_ms': round(self.percentile(0.50) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'sqlite_ms': round(self.db_time * 1000, 3),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+class Stats:
+    """
+    Contatori per comando/sottocomando: numero, errori, istogramma delle latenze,
+    tempo in SQLite e byte in/out. gauges è una funzione che restituisce i valori
+    istantanei (connessioni, sessioni, ...) al momento del report.
+    """
+    def __init__(self, gauges=None):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.started = time.time()
+        self.gauges = gauges
+
+    def record(self, key, elapsed, error=False, db_time=0.0, bytes_in=0, bytes_out=0):
+        i = bisect.bisect_left(LATENCY_BOUNDS, elapsed)
+        with self.lock:
+            s = self.commands.get(key)
+            if s is None:
+                if len(self.commands) >= MAX_KEYS:
+                    key = 'OTHER'
+                    s = self.commands.get(key)
+                if s is None:
+                    s = self.commands[key] = CommandStats()
+            s.count += 1
+            s.errors += error
+            s.total += elapsed
+            if elapsed > s.max:
+                s.max = elapsed
+            s.db_time += db_time
+            s.bytes_in += bytes_in
+            s.bytes_out += bytes_out
+            s.buckets[i] += 1
+
+    def snapshot(self):
+        with self.lock:
+            commands = {k: v.as_dict() for k, v in self.commands.items()}
+        return {
+            'time': int(time.time()),
+            'uptime': int(time.time() - self.started),
+            'gauges': self.gauges() if self.gauges else {},
+            'commands': dict(sorted(commands.items())),
+        }
+
+    def report(self, as_json=False):
+        snap = self.snapshot()
+        if as_json:
+            return json.dumps(snap, sort_keys=True) + "\nOK\n"
+        out = [f"Uptime: {snap['uptime']}s\n"]
+        out.extend(f"{k}: {v}\n" for k, v in sorted(snap['gauges'].items()))
+        out.append(f"{'COMANDO':<20}{'N':>8}{'ERR':>6}{'P50ms':>9}{'P95ms':>9}{'P99ms':>9}"
+                   f"{'MAXms':>9}{'SQLms':>10}{'IN':>10}{'OUT':>12}\n")
+        for key, s in snap['commands'].items():
+            out.append(f"{key:<20}{s['count']:>8}{s['errors']:>6}{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}"
+                       f"{s['p99_ms']:>9.1f}{s['max_ms']:>9.1f}{s['sqlite_ms']:>10.1f}"
+                       f"{s['bytes_in']:>10}{s['bytes_out']:>12}\n")
+        out.append("OK\n")
+        return "".join(out)
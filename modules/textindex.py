@@ -0,0 +1,154 @@
+import os
+import re
+import sqlite3
+import logging
+import threading
+import unicodedata
+
+INDEX_PATH = '/opt/mybbs/data/textindex.db'
+SEARCH_MAX_FILES = 20
+SNIPPETS_PER_FILE = 3
+SNIPPET_CHARS = 160
+
+class TextIndex:
+    """
+    Indice invertito su disco (SQLite) dei documenti dell'archivio testuale:
+    per ogni termine le coppie (documento, riga) in cui compare.
+    Una ricerca legge solo le posting dei termini richiesti; l'aggiornamento
+    reindicizza soltanto i documenti con mtime o dimensione cambiati.
+    """
+    def __init__(self, index_path=INDEX_PATH):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(index_path, check_same_thread=False)
+        # L'indice si può sempre ricostruire dai documenti: niente fsync a ogni commit
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                name TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lines (
+                name TEXT NOT NULL,
+                lineno INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (name, lineno)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                name TEXT NOT NULL,
+                lineno INTEGER NOT NULL,
+                PRIMARY KEY (term, name, lineno)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_postings_name ON postings(name);
+        """)
+        self.indexed = {r[0]: (r[1], r[2]) for r in
+                        self.conn.execute("SELECT name, mtime_ns, size FROM docs")}
+        self.generation = None
+
+    def tokenize(self, text):
+        # Minuscole e senza accenti, così "Perché" e "perche" coincidono
+        text = unicodedata.normalize('NFKD', text.lower())
+        text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+        return re.findall(r'\w{2,}', text)
+
+    def sync(self, doc_path, docs, generation):
+        """
+        Allinea l'indice all'elenco docs (nome -> (mtime_ns, size)) prodotto
+        dall'ultima scansione di TextLib; generation evita il confronto se nulla è cambiato.
+        """
+        if generation == self.generation:
+            return
+        with self.lock:
+            if generation == self.generation:
+                return
+            changed = [n for n, meta in docs.items() if self.indexed.get(n) != meta]
+            removed = [n for n in self.indexed if n not in docs]
+            if changed or removed:
+                with self.conn:
+                    for name in removed + changed:
+                        self.conn.execute("DELETE FROM postings WHERE name=?", (name,))
+                        self.conn.execute("DELETE FROM lines WHERE name=?", (name,))
+                        self.conn.execute("DELETE FROM docs WHERE name=?", (name,))
+                        self.indexed.pop(name, None)
+                    for name in changed:
+                        self.index_file(doc_path, name, docs[name])
+                logging.info(f"Indice testi aggiornato: {len(changed)} documenti reindicizzati, "
+                             f"{len(removed)} rimossi.")
+            self.generation = generation
+
+    def index_file(self, doc_path, name, meta):
+        try:
+            with open(os.path.join(doc_path, name), 'rb') as f:
+                content = f.read().decode('utf-8', errors='replace')
+        except OSError as e:
+            logging.warning(f"Indicizzazione di {name} fallita: {e}")
+            return
+        lines = []
+        postings = []
+        for lineno, line in enumerate(content.splitlines(), 1):
+            terms = set(self.tokenize(line))
+            if not terms:
+                continue
+            lines.append((name, lineno, line))
+            postings.extend((t, name, lineno) for t in terms)
+        self.conn.executemany("INSERT INTO lines(name, lineno, text) VALUES (?, ?, ?)", lines)
+        self.conn.executemany("INSERT INTO postings(term, name, lineno) VALUES (?, ?, ?)", postings)
+        self.conn.execute("INSERT INTO docs(name, mtime_ns, size) VALUES (?, ?, ?)", (name, meta[0], meta[1]))
+        self.indexed[name] = meta
+
+    def search(self, query, max_files=SEARCH_MAX_FILES):
+        """
+        Documenti che contengono tutti i termini (in righe anche diverse), ordinati
+        per numero di occorrenze, ciascuno con le righe più pertinenti.
+        "parola*" cerca per prefisso. Restituisce [(nome, occorrenze, [(riga, testo)])].
+        """
+        words = re.findall(r'\w+\*?', query)
+        terms = []
+        for w in words:
+            toks = self.tokenize(w.rstrip('*'))
+            if toks:
+                terms.append((toks[0], w.endswith('*')))
+        if not terms:
+            return []
+
+        with self.lock:
+            per_term = []
+            for term, prefix in terms:
+                if prefix:
+                    rows = self.conn.execute(
+                        "SELECT name, lineno FROM postings WHERE term >= ? AND term < ?",
+                        (term, term + '\U0010ffff'))
+                else:
+                    rows = self.conn.execute(
+                        "SELECT name, lineno FROM postings WHERE term = ?", (term,))
+                hits = {}
+                for name, lineno in rows:
+                    hits.setdefault(name, set()).add(lineno)
+                per_term.append(hits)
+
+            names = set(per_term[0])
+            for hits in per_term[1:]:
+                names &= set(hits)
+            ranked = sorted(names, key=lambda n: (-sum(len(h[n]) for h in per_term), n))[:max_files]
+
+            results = []
+            for name in ranked:
+                # Prima le righe che contengono più termini, poi in ordine di posizione
+                score = {}
+                for hits in per_term:
+                    for lineno in hits[name]:
+                        score[lineno] = score.get(lineno, 0) + 1
+                best = sorted(score, key=lambda l: (-score[l], l))[:SNIPPETS_PER_FILE]
+                marks = ','.join('?' * len(best))
+                texts = dict(self.conn.execute(
+                    f"SELECT lineno, text FROM lines WHERE name=? AND lineno IN ({marks})",
+                    (name, *best)))
+                snippets = [(l, ' '.join(texts.get(l, '').split())[:SNIPPET_CHARS]) for l in sorted(best)]
+                results.append((name, sum(len(h[name]) for h in per_term), snippets))
+        return results
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
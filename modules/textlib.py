@@ -1,33 +1,99 @@
 import os
+import mmap
+import time
 import logging
+import threading
+from collections import OrderedDict
+from modules.textindex import TextIndex, INDEX_PATH
+from modules.revisions import Revisions, split_ifnewer
+
+CACHE_BYTES = 8 * 1024 * 1024      # memoria massima per i documenti in cache
+CACHE_MAX_ENTRY = 1024 * 1024      # oltre questa dimensione un documento si legge a pagine
+PAGE_BYTES = 64 * 1024             # pagina predefinita di TEXT READ a intervalli
+MAX_PAGE_BYTES = 1024 * 1024
+POLL_INTERVAL = 5.0                # secondi tra due scansioni della cartella
+DOCS_DIR = '/opt/mybbs/data/docs'
+
+def split_range(arg):
+    """
+    'guida utente.txt 100 50' -> ('guida utente.txt', [100, 50]): offset e lunghezza
+    si tolgono da destra, così i nomi con spazi restano interi (finiscono sempre in .txt).
+    """
+    fn, numbers = arg.strip(), []
+    while len(numbers) < 2:
+        head, _, tail = fn.rpartition(' ')
+        if not head or not tail.lstrip('-').isdigit():
+            break
+        numbers.insert(0, int(tail))
+        fn = head.rstrip()
+    return fn, numbers
 
 class TextLib:
-    def __init__(self, doc_path='/opt/mybbs/data/docs'):
+    def __init__(self, doc_path=DOCS_DIR, cache_bytes=CACHE_BYTES,
+                 max_entry=CACHE_MAX_ENTRY, poll_interval=POLL_INTERVAL, index_path=INDEX_PATH,
+                 revisions=None):
         self.doc_path = doc_path
+        self.cache_bytes = cache_bytes
+        self.max_entry = max_entry
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.docs = {}              # nome -> (mtime_ns, size) all'ultima scansione
+        self.listing = ""           # righe di TEXT LIST già pronte
+        self.cache = OrderedDict()  # nome -> bytes, in ordine LRU
+        self.cache_used = 0
+        self.last_scan = None
+        self.generation = 0         # cresce a ogni scansione che trova differenze
+        self.index = TextIndex(index_path)
+        self.revisions = revisions if revisions is not None else Revisions()
 
     def handle_command(self, line):
         parts = line.strip().split(' ', 1)
         cmd = parts[0].upper() if parts else ''
         arg = parts[1].strip() if len(parts) > 1 else ''
         try:
+            # Le modifiche ai documenti si vedono con la scansione periodica della cartella:
+            # tra una scansione e l'altra IFNEWER risponde senza toccare il disco
+            self.refresh()
             if cmd == 'LIST':
-                docs = os.listdir(self.doc_path)
-                out = ""
-                for d in docs:
-                    if d.endswith('.txt'):
-                        out += d + "\n"
-                return out + "OK\n"
+                # TEXT LIST [IFNEWER <rev>]
+                try:
+                    since, _ = split_ifnewer(arg)
+                except ValueError:
+                    return "ERR LIST [IFNEWER <rev>]\n"
+                rev = self.revisions.get('docs')
+                if since is not None and rev <= since:
+                    return "OK NOTMODIFIED\n"
+                return self.listing + f"OK REV {rev}\n"
 
             elif cmd == 'READ':
-                if not arg:
-                    return "ERR READ <filename>\n"
-                fn = arg.strip()
-                path = os.path.join(self.doc_path, fn)
-                if not os.path.exists(path):
+                # TEXT READ [IFNEWER <rev>] <filename> [offset] [length]
+                try:
+                    since, arg = split_ifnewer(arg)
+                    fn, numbers = split_range(arg)
+                    if not fn:
+                        return "ERR READ <filename>\n"
+                    offset = numbers[0] if numbers else None
+                    length = numbers[1] if len(numbers) > 1 else None
+                except ValueError:
+                    return "ERR READ [IFNEWER <rev>] <filename> [offset] [length]\n"
+                if fn not in self.docs:
                     return "ERR Not found\n"
-                with open(path, 'r') as f:
-                    data = f.read()
-                return data + "\nOK\n"
+                rev = self.revisions.get(('doc', fn))
+                if since is not None and rev <= since:
+                    return "OK NOTMODIFIED\n"
+                return self.read_doc(fn, offset, length, rev)
+
+            elif cmd == 'SEARCH':
+                # TEXT SEARCH <termini>
+                if not arg:
+                    return "ERR SEARCH <termini>\n"
+                self.index.sync(self.doc_path, self.docs, self.generation)
+                resp = ""
+                for name, hits, snippets in self.index.search(arg):
+                    resp += f"{name} ({hits})\n"
+                    for lineno, text in snippets:
+                        resp += f"  {lineno}: {text}\n"
+                return resp + "OK\n"
 
             else:
                 return "ERR Unknown text command\n"
@@ -35,3 +101,93 @@ class TextLib:
             logging.error(f"Errore TextLib cmd={cmd}, arg={arg}: {e}")
             return "ERR Server error\n"
 
+    def refresh(self, force=False):
+        """
+        Ricontrolla la cartella al massimo una volta ogni poll_interval secondi:
+        i documenti con mtime o dimensione cambiati escono dalla cache.
+        """
+        now = time.monotonic()
+        if not force and self.last_scan is not None and now - self.last_scan < self.poll_interval:
+            return
+        with self.lock:
+            if not force and self.last_scan is not None and now - self.last_scan < self.poll_interval:
+                return
+            docs = {}
+            with os.scandir(self.doc_path) as it:
+                for entry in it:
+                    if entry.name.endswith('.txt') and entry.is_file():
+                        st = entry.stat()
+                        docs[entry.name] = (st.st_mtime_ns, st.st_size)
+            if docs == self.docs and self.last_scan is not None:
+                self.last_scan = now
+                return
+            for name in list(self.cache):
+                if docs.get(name) != self.docs.get(name):
+                    self.cache_used -= len(self.cache.pop(name))
+            changed = [('doc', n) for n in docs.keys() | self.docs.keys() if docs.get(n) != self.docs.get(n)]
+            if docs.keys() != self.docs.keys():
+                changed.append('docs')
+            self.docs = docs
+            self.generation += 1
+            self.listing = "".join(f"{d}\n" for d in sorted(docs))
+            self.revisions.bump(*changed)
+            self.last_scan = now
+
+    def cached(self, name):
+        """Contenuto del documento dalla cache LRU; None se è troppo grande per la cache."""
+        meta = self.docs.get(name)
+        with self.lock:
+            data = self.cache.get(name)
+            if data is not None:
+                self.cache.move_to_end(name)
+                return data
+        if meta is None or meta[1] > self.max_entry:
+            return None
+        with open(os.path.join(self.doc_path, name), 'rb') as f:
+            data = f.read()
+        with self.lock:
+            # Si memorizza solo se nel frattempo la scansione non ha visto cambiare il file
+            if self.docs.get(name) == meta and name not in self.cache:
+                self.cache[name] = data
+                self.cache_used += len(data)
+                while self.cache_used > self.cache_bytes and self.cache:
+                    _, old = self.cache.popitem(last=False)
+                    self.cache_used -= len(old)
+        return data
+
+    def read_doc(self, name, offset, length, rev):
+        data = self.cached(name)
+        if data is not None and offset is None and length is None:
+            return data.decode('utf-8', errors='replace') + f"\nOK REV {rev}\n"
+
+        offset = max(0, offset or 0)
+        length = max(1, min(length or PAGE_BYTES, MAX_PAGE_BYTES))
+        if data is not None:
+            return self.page(data, len(data), offset, length, rev)
+        # Documenti grandi: mappati in memoria, si copia solo la pagina richiesta
+        with open(os.path.join(self.doc_path, name), 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            if total == 0:
+                return self.page(b"", 0, offset, length, rev)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return self.page(m, total, offset, length, rev)
+
+    def page(self, buf, total, offset, length, rev):
+        start = min(offset, total)
+        end = min(total, start + length)
+        if end < total:
+            # La pagina si chiude a fine riga, o almeno su un confine di carattere UTF-8
+            nl = buf.rfind(b"\n", start, end)
+            if nl >= start:
+                end = nl + 1
+            else:
+                while end > start and (buf[end] & 0xC0) == 0x80:
+                    end -= 1
+            if end == start:
+                end = min(total, start + length)
+        text = buf[start:end].decode('utf-8', errors='replace')
+        if text and not text.endswith("\n"):
+            text += "\n"
+        if end < total:
+            return text + f"OK MORE {end} REV {rev}\n"
+        return text + f"OK REV {rev}\n"
@@ -2,32 +2,159 @@ import sqlite3
 import bcrypt
 import logging
 import time
+import os
+import gzip
 import shutil
+import hashlib
+import secrets
+import threading
+
+log = logging.getLogger('bbs.auth')
+
+SESSION_TTL = 7 * 24 * 3600  # validità (s) di un token di sessione dall'ultimo uso
+SESSION_PURGE_INTERVAL = 3600  # ogni quanto (s) un login scarta anche i token scaduti
+BACKUP_PATH = '/opt/mybbs/data/database_backup.db'
+BACKUP_PAGES = 256           # pagine copiate per passo del backup online
+BACKUP_PAUSE = 0.02          # pausa (s) tra due passi, per lasciare spazio alle scritture
+PMSG_PAGE_SIZE = 50          # messaggi privati per pagina di PMSG LIST
+PMSG_MAX_PAGE_SIZE = 500
+PMSG_PREVIEW = 40            # caratteri del testo mostrati nell'elenco
+
+class UserDirectory:
+    """
+    Cache in memoria di id -> (username, ruolo) condivisa da tutti i moduli.
+    Si carica per intero al primo uso e si invalida a ogni modifica degli utenti;
+    le letture non prendono lock, leggono un'istantanea immutabile.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.maps = None        # (by_id, by_name)
+        self.generation = 0
+
+    def snapshot(self):
+        maps = self.maps
+        if maps is not None:
+            return maps
+        with self.lock:
+            generation = self.generation
+        rows = self.db.reader().execute("SELECT id, username, role FROM users").fetchall()
+        by_id = {r['id']: (r['username'], r['role']) for r in rows}
+        by_name = {r['username']: r['id'] for r in rows}
+        maps = (by_id, by_name)
+        with self.lock:
+            # Se nel frattempo qualcuno ha invalidato, l'istantanea letta è già vecchia
+            if generation == self.generation:
+                self.maps = maps
+        return maps
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.maps = None
+
+    def get(self, user_id):
+        return self.snapshot()[0].get(user_id)
+
+    def username(self, user_id, default='???'):
+        entry = self.snapshot()[0].get(user_id)
+        return entry[0] if entry else default
+
+    def role(self, user_id, default='user'):
+        entry = self.snapshot()[0].get(user_id)
+        return entry[1] if entry else default
+
+    def user_id(self, username):
+        return self.snapshot()[1].get(username)
 
 class UsersManager:
-    def __init__(self, conn):
-        self.conn = conn
+    def __init__(self, db, session_ttl=SESSION_TTL):
+        self.db = db
+        self.session_ttl = session_ttl
+        self.next_purge = 0
+        self.directory = UserDirectory(db)
+        self.ensure_schema()
+
+    def ensure_schema(self):
+        with self.db.writer() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    token_hash TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+            self.ensure_pmsg_schema(conn)
+
+    def ensure_pmsg_schema(self, conn):
+        """
+        Indice della casella (destinatario, letto, id) e contatore dei non letti per
+        utente, tenuto aggiornato dai trigger nella stessa transazione di ogni
+        INSERT/UPDATE/DELETE: PMSG UNREAD è una lettura per chiave primaria.
+        """
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pmsg_inbox ON private_messages(to_id, read_flag, id)")
+        # I trigger li crea solo il server: se mancano, il contatore (anche se la tabella
+        # viene da schema.sql) non ha mai seguito i messaggi e va ricalcolato
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='pmsg_unread_ai'"
+        ).fetchone()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pmsg_unread (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS pmsg_unread_ai AFTER INSERT ON private_messages
+            WHEN new.read_flag = 0 BEGIN
+                INSERT INTO pmsg_unread(user_id, count) VALUES (new.to_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET count = count + 1;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS pmsg_unread_ad AFTER DELETE ON private_messages
+            WHEN old.read_flag = 0 BEGIN
+                UPDATE pmsg_unread SET count = count - 1 WHERE user_id = old.to_id;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS pmsg_unread_au AFTER UPDATE OF read_flag ON private_messages
+            WHEN (old.read_flag = 0) <> (new.read_flag = 0) BEGIN
+                INSERT INTO pmsg_unread(user_id, count) VALUES (new.to_id, 0)
+                ON CONFLICT(user_id) DO NOTHING;
+                UPDATE pmsg_unread SET count = count + (CASE WHEN new.read_flag = 0 THEN 1 ELSE -1 END)
+                WHERE user_id = new.to_id;
+            END
+        """)
+        if not exists:
+            conn.execute("DELETE FROM pmsg_unread")
+            conn.execute("""
+                INSERT INTO pmsg_unread(user_id, count)
+                SELECT to_id, COUNT(*) FROM private_messages WHERE read_flag = 0 GROUP BY to_id
+            """)
 
     def add_user(self, username, password, role='user'):
-        c = self.conn.cursor()
         phash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
         try:
-            c.execute("""
-                INSERT INTO users(username, password_hash, role)
-                VALUES (?, ?, ?)
-            """, (username, phash.decode('utf-8'), role))
-            self.conn.commit()
-            logging.info(f"Creato utente '{username}', ruolo={role}.")
+            with self.db.writer() as conn:
+                conn.execute("""
+                    INSERT INTO users(username, password_hash, role)
+                    VALUES (?, ?, ?)
+                """, (username, phash.decode('utf-8'), role))
+            self.directory.invalidate()
+            log.info(f"Creato utente '{username}', ruolo={role}.")
             return True
         except sqlite3.IntegrityError:
-            logging.warning(f"Utente '{username}' già esistente.")
+            log.warning(f"Utente '{username}' già esistente.")
             return False
         except Exception as e:
-            logging.error(f"Errore add_user '{username}': {e}")
+            log.error(f"Errore add_user '{username}': {e}")
             return False
 
     def authenticate(self, username, password):
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         try:
             c.execute("SELECT id, password_hash FROM users WHERE username=?", (username,))
             row = c.fetchone()
@@ -37,35 +164,218 @@ class UsersManager:
                     return row['id']
             return None
         except Exception as e:
-            logging.error(f"Errore authenticate '{username}': {e}")
+            log.error(f"Errore authenticate '{username}': {e}")
             return None
 
-    def get_role(self, user_id):
-        c = self.conn.cursor()
+    # Token di sessione: il client li usa con RESUME per riconnettersi senza password.
+    # Nel DB si conserva solo lo SHA-256 del token.
+    def create_session(self, user_id):
+        token = secrets.token_urlsafe(32)
+        now = int(time.time())
+        # I token scaduti si scartano di rado, nella stessa scrittura del nuovo:
+        # un solo commit di gruppo per login
+        purge = now >= self.next_purge
+        if purge:
+            self.next_purge = now + SESSION_PURGE_INTERVAL
+
+        def insert(conn):
+            if purge:
+                conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+            conn.execute("""
+                INSERT INTO sessions(token_hash, user_id, expires_at)
+                VALUES (?, ?, ?)
+            """, (self.hash_token(token), user_id, now + self.session_ttl))
+        try:
+            self.db.submit(insert).result()
+            return token
+        except Exception as e:
+            log.error(f"Errore create_session user_id={user_id}: {e}")
+            return None
+
+    def resume_session(self, token):
+        """Restituisce (user_id, username) se il token è valido e non scaduto, altrimenti None."""
+        c = self.db.reader().cursor()
+        now = int(time.time())
         try:
-            c.execute("SELECT role FROM users WHERE id=?", (user_id,))
+            token_hash = self.hash_token(token)
+            c.execute("SELECT user_id FROM sessions WHERE token_hash=? AND expires_at >= ?",
+                      (token_hash, now))
             row = c.fetchone()
-            if row:
-                return row['role']
-            return 'user'
+            if not row:
+                return None
+            entry = self.directory.get(row['user_id'])
+            if entry is None:
+                return None
+            self.db.execute_write("UPDATE sessions SET expires_at=? WHERE token_hash=?",
+                                  (now + self.session_ttl, token_hash))
+            return row['user_id'], entry[0]
+        except Exception as e:
+            log.error(f"Errore resume_session: {e}")
+            return None
+
+    def revoke_session(self, token):
+        try:
+            self.db.execute_write("DELETE FROM sessions WHERE token_hash=?", (self.hash_token(token),))
         except Exception as e:
-            logging.error(f"Errore get_role user_id={user_id}: {e}")
+            log.error(f"Errore revoke_session: {e}")
+
+    def hash_token(self, token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get_role(self, user_id):
+        try:
+            return self.directory.role(user_id)
+        except Exception as e:
+            log.error(f"Errore get_role user_id={user_id}: {e}")
             return 'user'
 
     def handle_private_message(self, line, user_id):
-        # (Come già implementato, con LIST, READ, WRITE)
-        # ...
-        pass
+        parts = line.strip().split(' ', 1)
+        cmd = parts[0].upper() if parts else ''
+        arg = parts[1].strip() if len(parts) > 1 else ''
+        c = self.db.reader().cursor()
+        try:
+            if cmd == 'LIST':
+                # PMSG LIST [ALL] [before_id] [limit]: i più recenti per primi, solo non letti
+                # salvo ALL; la pagina successiva si chiede con OK MORE <id>
+                args = arg.split()
+                show_all = bool(args) and args[0].upper() == 'ALL'
+                if show_all:
+                    args = args[1:]
+                try:
+                    before_id = int(args[0]) if len(args) > 0 else None
+                    limit = int(args[1]) if len(args) > 1 else PMSG_PAGE_SIZE
+                except ValueError:
+                    return "ERR LIST [ALL] [before_id] [limit]\n"
+                limit = max(1, min(limit, PMSG_MAX_PAGE_SIZE))
+                # Una scansione dell'indice per ciascun valore di read_flag, poi si uniscono:
+                # il costo dipende dalla pagina, non da quanti messaggi ha l'utente
+                rows = []
+                for flag in ((0, 1) if show_all else (0,)):
+                    c.execute("""
+                        SELECT id, from_id, timestamp, body, read_flag
+                        FROM private_messages
+                        WHERE to_id = ? AND read_flag = ? AND id < ?
+                        ORDER BY id DESC
+                        LIMIT ?
+                    """, (user_id, flag, before_id if before_id is not None else 2 ** 63 - 1, limit + 1))
+                    rows.extend(c.fetchall())
+                rows.sort(key=lambda r: r['id'], reverse=True)
+                more = len(rows) > limit
+                rows = rows[:limit]
+                users = self.directory.snapshot()[0]
+                out = []
+                for r in rows:
+                    uname = users.get(r['from_id'], ('???',))[0]
+                    new = " (nuovo)" if r['read_flag'] == 0 else ""
+                    preview = ' '.join(r['body'].split())
+                    if len(preview) > PMSG_PREVIEW:
+                        preview = preview[:PMSG_PREVIEW] + "..."
+                    out.append(f"{r['id']} from {uname} at {r['timestamp']}{new}: {preview}\n")
+                if more:
+                    out.append(f"OK MORE {rows[-1]['id']}\n")
+                else:
+                    out.append("OK\n")
+                return "".join(out)
+
+            elif cmd == 'READ':
+                # PMSG READ <id> [<id> ...]: li mostra e li segna come letti con un solo UPDATE
+                try:
+                    ids = [int(x) for x in arg.split()]
+                except ValueError:
+                    return "ERR READ <id> [<id> ...]\n"
+                if not ids:
+                    return "ERR READ <id> [<id> ...]\n"
+                ids = ids[:PMSG_MAX_PAGE_SIZE]
+                marks = ','.join('?' * len(ids))
+                c.execute(f"""
+                    SELECT id, from_id, timestamp, body, read_flag
+                    FROM private_messages
+                    WHERE to_id = ? AND id IN ({marks})
+                    ORDER BY id
+                """, (user_id, *ids))
+                rows = c.fetchall()
+                if not rows:
+                    return "ERR Not found\n"
+                unread = [r['id'] for r in rows if r['read_flag'] == 0]
+                if unread:
+                    self.db.execute_write(
+                        f"UPDATE private_messages SET read_flag = 1 WHERE to_id = ? AND id IN ({','.join('?' * len(unread))})",
+                        (user_id, *unread))
+                users = self.directory.snapshot()[0]
+                out = []
+                for r in rows:
+                    uname = users.get(r['from_id'], ('???',))[0]
+                    out.append(f"ID:{r['id']} From:{uname} At:{r['timestamp']}\n{r['body']}\n\n")
+                return "".join(out) + "OK\n"
+
+            elif cmd == 'WRITE':
+                # PMSG WRITE <utente>|<testo>
+                if '|' not in arg:
+                    return "ERR WRITE <user>|<text>\n"
+                to_user, body = arg.split('|', 1)
+                to_id = self.directory.user_id(to_user.strip())
+                if to_id is None:
+                    return "ERR user not found\n"
+                if not body.strip():
+                    return "ERR Empty message\n"
+                ts = time.strftime('%Y-%m-%d %H:%M:%S')
+                self.db.execute_write("""
+                    INSERT INTO private_messages(from_id, to_id, timestamp, body)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, to_id, ts, body))
+                return "OK Message sent\n"
+
+            elif cmd == 'UNREAD':
+                # PMSG UNREAD: numero di messaggi non letti, dal contatore
+                c.execute("SELECT count FROM pmsg_unread WHERE user_id = ?", (user_id,))
+                row = c.fetchone()
+                return f"OK {row['count'] if row else 0}\n"
+
+            elif cmd == 'READALL':
+                # PMSG READALL: segna come letti tutti i messaggi in un'unica istruzione
+                n = self.db.submit(lambda conn: conn.execute(
+                    "UPDATE private_messages SET read_flag = 1 WHERE to_id = ? AND read_flag = 0",
+                    (user_id,)).rowcount).result()
+                return f"OK {n} marked read\n"
+
+            elif cmd == 'DELETE':
+                # PMSG DELETE <id> [<id> ...] | PMSG DELETE READ (tutti quelli già letti)
+                if arg.upper() == 'READ':
+                    sql, params = "DELETE FROM private_messages WHERE to_id = ? AND read_flag = 1", (user_id,)
+                else:
+                    try:
+                        ids = [int(x) for x in arg.split()][:PMSG_MAX_PAGE_SIZE]
+                    except ValueError:
+                        ids = []
+                    if not ids:
+                        return "ERR DELETE <id> [<id> ...] | DELETE READ\n"
+                    sql = f"DELETE FROM private_messages WHERE to_id = ? AND id IN ({','.join('?' * len(ids))})"
+                    params = (user_id, *ids)
+                n = self.db.submit(lambda conn: conn.execute(sql, params).rowcount).result()
+                if not n:
+                    return "ERR Not found\n"
+                return f"OK {n} deleted\n"
+
+            else:
+                return "ERR Unknown PMSG command\n"
+
+        except Exception as e:
+            log.error(f"Errore messaggi privati cmd={cmd}, user_id={user_id}: {e}")
+            return "ERR Server error\n"
 
     def handle_admin_command(self, line):
         parts = line.split(' ')
         cmd = parts[0].lower() if parts else ''
         try:
             if cmd == 'adduser':
-                # ADMIN adduser <username>
+                # ADMIN adduser <username> [password]
                 if len(parts) < 2:
                     return "ERR adduser <username>\n"
                 username = parts[1]
+                if len(parts) > 2:
+                    ok = self.add_user(username, ' '.join(parts[2:]), role='admin')
+                    return f"OK User {username} added\n" if ok else "ERR Could not add user\n"
                 pw = "admin123"
                 ok = self.add_user(username, pw, role='admin')
                 if ok:
@@ -77,6 +387,9 @@ class UsersManager:
                 if len(parts) < 2:
                     return "ERR adduser-nonadmin <username>\n"
                 username = parts[1]
+                if len(parts) > 2:
+                    ok = self.add_user(username, ' '.join(parts[2:]), role='user')
+                    return f"OK User {username} added\n" if ok else "ERR Could not add user\n"
                 pw = "user123"
                 ok = self.add_user(username, pw, role='user')
                 if ok:
@@ -113,13 +426,24 @@ class UsersManager:
                 return out + "OK\n"
 
             elif cmd == 'backup':
-                # ADMIN backup <path>?
-                if len(parts) > 1:
-                    backup_path = ' '.join(parts[1:])
-                else:
-                    backup_path = '/opt/mybbs/data/database_backup.db'
-                ok = self.backup_database(backup_path)
+                # ADMIN backup [path] [gz] [keep=N]
+                args = parts[1:]
+                compress = False
+                keep = 0
+                while args and (args[-1] == 'gz' or args[-1].startswith('keep=')):
+                    opt = args.pop()
+                    if opt == 'gz':
+                        compress = True
+                    else:
+                        try:
+                            keep = max(0, int(opt[5:]))
+                        except ValueError:
+                            return "ERR backup [path] [gz] [keep=N]\n"
+                backup_path = ' '.join(args) if args else BACKUP_PATH
+                ok = self.backup_database(backup_path, compress, keep)
                 if ok:
+                    if compress and not backup_path.endswith('.gz'):
+                        backup_path += '.gz'
                     return f"OK Backup done in '{backup_path}'\n"
                 else:
                     return "ERR Backup failed\n"
@@ -127,14 +451,14 @@ class UsersManager:
             else:
                 return "ERR Unknown admin command\n"
         except Exception as e:
-            logging.error(f"Errore handle_admin_command: {e}")
+            log.error(f"Errore handle_admin_command: {e}")
             return "ERR Server error\n"
 
     def change_password(self, user_id, arg):
         if '|' not in arg:
             return "ERR Formato: PASSWD <oldpw>|<newpw>\n"
         oldpw, newpw = arg.split('|', 1)
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         try:
             c.execute("SELECT username, password_hash FROM users WHERE id=?", (user_id,))
             row = c.fetchone()
@@ -145,55 +469,90 @@ class UsersManager:
             if not bcrypt.checkpw(oldpw.encode('utf-8'), phash):
                 return "ERR Vecchia password non corretta\n"
             new_hash = bcrypt.hashpw(newpw.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            c.execute("UPDATE users SET password_hash=? WHERE id=?", (new_hash, user_id))
-            self.conn.commit()
+            with self.db.writer() as conn:
+                conn.execute("UPDATE users SET password_hash=? WHERE id=?", (new_hash, user_id))
+                # I token emessi con la vecchia password non valgono più
+                conn.execute("DELETE FROM sessions WHERE user_id=?", (user_id,))
+            self.directory.invalidate()
             return "OK Password aggiornata\n"
         except Exception as e:
-            logging.error(f"Errore change_password user_id={user_id}: {e}")
+            log.error(f"Errore change_password user_id={user_id}: {e}")
             return "ERR Server error\n"
 
     # Metodi di supporto admin CLI
     def delete_user(self, username):
-        c = self.conn.cursor()
         try:
-            c.execute("DELETE FROM users WHERE username=?", (username,))
-            self.conn.commit()
+            with self.db.writer() as conn:
+                conn.execute("""
+                    DELETE FROM sessions
+                    WHERE user_id IN (SELECT id FROM users WHERE username=?)
+                """, (username,))
+                conn.execute("DELETE FROM users WHERE username=?", (username,))
+            self.directory.invalidate()
         except Exception as e:
-            logging.error(f"Errore delete_user '{username}': {e}")
+            log.error(f"Errore delete_user '{username}': {e}")
 
     def promote_user(self, username):
-        c = self.conn.cursor()
         try:
-            c.execute("UPDATE users SET role='admin' WHERE username=?", (username,))
-            self.conn.commit()
+            with self.db.writer() as conn:
+                conn.execute("UPDATE users SET role='admin' WHERE username=?", (username,))
+            self.directory.invalidate()
         except Exception as e:
-            logging.error(f"Errore promote_user '{username}': {e}")
+            log.error(f"Errore promote_user '{username}': {e}")
 
     def demote_user(self, username):
-        c = self.conn.cursor()
         try:
-            c.execute("UPDATE users SET role='user' WHERE username=?", (username,))
-            self.conn.commit()
+            with self.db.writer() as conn:
+                conn.execute("UPDATE users SET role='user' WHERE username=?", (username,))
+            self.directory.invalidate()
         except Exception as e:
-            logging.error(f"Errore demote_user '{username}': {e}")
+            log.error(f"Errore demote_user '{username}': {e}")
 
     def list_users(self):
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         c.execute("SELECT username, role FROM users")
         rows = c.fetchall()
         return rows
 
-    def backup_database(self, backup_path):
+    def backup_database(self, backup_path, compress=False, keep=0):
+        """
+        Backup online (API di backup di SQLite) verificato con integrity_check,
+        opzionalmente compresso con gzip. Con keep > 0 le copie precedenti
+        vengono ruotate in <file>.1 ... <file>.<keep>.
+        """
+        final = backup_path + '.gz' if compress and not backup_path.endswith('.gz') else backup_path
+        tmp = final + '.tmp'
         try:
-            c = self.conn.cursor()
-            c.execute("PRAGMA database_list")
-            row = c.fetchone()
-            if row and row[2]:
-                db_path = row[2]
-                shutil.copy2(db_path, backup_path)
-                return True
-            return False
+            t0 = time.monotonic()
+            result = self.db.backup(tmp, pages=BACKUP_PAGES, pause=BACKUP_PAUSE)
+            if result != 'ok':
+                log.error(f"Backup DB non integro ({result}), scartato.")
+                os.remove(tmp)
+                return False
+            if compress:
+                with open(tmp, 'rb') as src, gzip.open(tmp + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.replace(tmp + '.gz', tmp)
+            if keep > 0:
+                self.rotate_backups(final, keep)
+            os.replace(tmp, final)
+            log.info(f"Backup DB completato in {final} ({time.monotonic() - t0:.1f}s)")
+            return True
         except Exception as e:
-            logging.error(f"Errore backup DB: {e}")
+            log.error(f"Errore backup DB: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
             return False
 
+    def rotate_backups(self, path, keep):
+        """path -> path.1 -> ... -> path.<keep>; la copia più vecchia oltre keep viene eliminata."""
+        oldest = f"{path}.{keep}"
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(keep - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if os.path.exists(path):
+            os.replace(path, f"{path}.1")
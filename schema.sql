@@ -19,6 +19,9 @@ CREATE TABLE IF NOT EXISTS board_messages (
     FOREIGN KEY (parent_id) REFERENCES board_messages(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_board_parent ON board_messages(parent_id, id);
+-- L'indice full-text board_fts (FTS5) e i suoi trigger vengono creati e popolati dal server all'avvio.
+
 CREATE TABLE IF NOT EXISTS private_messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     from_id INTEGER NOT NULL,
@@ -30,12 +33,43 @@ CREATE TABLE IF NOT EXISTS private_messages (
     FOREIGN KEY (to_id) REFERENCES users(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_pmsg_inbox ON private_messages(to_id, read_flag, id);
+
+-- Messaggi non letti per utente; i trigger che lo aggiornano (pmsg_unread_ai/ad/au) vengono creati dal server all'avvio.
+CREATE TABLE IF NOT EXISTS pmsg_unread (
+    user_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+);
+
+-- Contenuti caricati, salvati una sola volta per sha256 in uploads/blobs/
+CREATE TABLE IF NOT EXISTS blobs (
+    sha TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs(sha) WHERE refcount = 0;
+
 CREATE TABLE IF NOT EXISTS files (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     uploader_id INTEGER NOT NULL,
     filename TEXT NOT NULL,
     description TEXT,
     visibility TEXT NOT NULL,
-    FOREIGN KEY (uploader_id) REFERENCES users(id)
+    blob_sha TEXT,
+    size INTEGER,
+    FOREIGN KEY (uploader_id) REFERENCES users(id),
+    FOREIGN KEY (blob_sha) REFERENCES blobs(sha)
+);
+
+CREATE INDEX IF NOT EXISTS idx_files_blob ON files(blob_sha, uploader_id);
+-- I trigger che aggiornano blobs.refcount (files_blob_ai/ad/au) vengono creati dal server all'avvio.
+
+CREATE TABLE IF NOT EXISTS sessions (
+    token_hash TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
@@ -1,3 +1,3 @@
 @echo off
 echo.
-bbs_cli.exe --host timrouter.dns.army --port 12345
\ No newline at end of file
+bbs_cli.exe --host timrouter.dns.army --port 12345 --compress
\ No newline at end of file